@@ -1,11 +1,15 @@
 import os
 import pickle
+import sys
 
 import matplotlib.pyplot as plt
 import numpy as np
 from sklearn.metrics import cohen_kappa_score, classification_report
 from tqdm import tqdm
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from results_store import ResultsStore  # noqa: E402
+
 
 def get_concreteness_from_file(file_name: str):
     """
@@ -26,21 +30,18 @@ def get_concreteness_from_file(file_name: str):
 
 def get_cossim_score_from_folders(folder_path: str):
     cossim_dict = {}
-    # For every folder in the folder_path
-    for folder in os.listdir(folder_path):
-        for subfolder in os.listdir(os.path.join(folder_path, folder)):
-            # The file is called cosine_scores.txt
-            cos_file = os.path.join(folder_path, folder, subfolder, "cosine_scores.txt")
-            with open(cos_file, 'r') as f:
-                # Take the max float of the first 5 lines of the file
-                lines = f.readlines()
-                # max_score = max([float(line.replace("\n", "")) for line in lines[:5]])
-                mean_score = np.mean([float(line.replace("\n", "")) for line in lines[:5]])
-                # Take the first word in subfolder.split("-") that does not contain _
-                word_list = [word for word in subfolder.split("-") if "_" not in word]
-                if len(word_list) > 0:
-                    word = word_list[0]
-                    cossim_dict[word.lower()] = mean_score
+    # The results store of the run sits next to output_middle and output_advanced
+    results = ResultsStore(os.path.join(folder_path, "results.npz"))
+    for output_set in ("middle", "advanced"):
+        for subfolder, scores in results.concept_scores(output_set).items():
+            # Take the mean score of the first 5 images
+            # max_score = max(scores[:5])
+            mean_score = np.mean(scores[:5])
+            # Take the first word in subfolder.split("-") that does not contain _
+            word_list = [word for word in subfolder.split("-") if "_" not in word]
+            if len(word_list) > 0:
+                word = word_list[0]
+                cossim_dict[word.lower()] = mean_score
     return cossim_dict
 
 
@@ -1,35 +1,56 @@
+import os
+import sys
+import time
+
 from sklearn.metrics import cohen_kappa_score, classification_report
 from tqdm import tqdm
-from transformers import AutoModelForCausalLM, AutoTokenizer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from llm_judge import YesNoJudge  # noqa: E402
+from telemetry import Stage  # noqa: E402
+
+TEMPLATE = "Is this a concrete english word? (example: dog -> yes, advantage -> no, beach -> yes, summer -> no, " \
+           "potato -> yes, youth -> no, ball -> yes) {word} ->"
 
 
 class TransFilter:
 
-    def __init__(self, words: list):
+    def __init__(self, words: list, batch_size: int = 100):
         self.words = words
         self.abstract_vs_concrete_dict = {}
+        # Probability that each word is abstract
+        self.abstract_probabilities = {}
         checkpoint = "facebook/opt-6.7b"
-        self.tokenizer = AutoTokenizer.from_pretrained(checkpoint)
-        self.model = AutoModelForCausalLM.from_pretrained(checkpoint, torch_dtype="auto", device_map="auto")
+        self.checkpoint = checkpoint
+        self.judge = YesNoJudge(checkpoint, TEMPLATE)
+        self.batch_size = batch_size
         self.process()
 
     def process(self):
-        for word in tqdm(self.words):
-            if not self.is_abstract(word):
-                self.abstract_vs_concrete_dict[word] = "concrete"
-            else:
-                self.abstract_vs_concrete_dict[word] = "abstract"
+        with Stage("abstract-filter", model=self.judge.model_id, batch_size=self.batch_size) as stage:
+            pbar = tqdm(total=len(self.words))
+            for i in range(0, len(self.words), self.batch_size):
+                batch = self.words[i:i + self.batch_size]
+                start = time.perf_counter()
+                for word, (abstract, probability) in zip(batch, self.abstract(batch)):
+                    self.abstract_vs_concrete_dict[word] = "abstract" if abstract else "concrete"
+                    self.abstract_probabilities[word] = probability
+                stage.item(latency=time.perf_counter() - start, count=len(batch))
+                pbar.update(len(batch))
+            pbar.close()
+
+    def abstract(self, words: list) -> list:
+        """
+        Returns, for each word, whether it is abstract and the probability that it is
+        (the model answering "no" to the concrete word question)
+        """
+        return [(1 - p > 0.5, 1 - p) for p in self.judge.yes_probabilities(words)]
 
     def is_abstract(self, word) -> bool:
         """
         Returns True if the word is abstract
         """
-        inputs = self.tokenizer.encode(
-            f"Is this a concrete english word? (example: dog -> yes, advantage -> no, beach -> yes, summer -> no, potato -> yes, youth -> no, ball -> yes) {word} ->",
-            return_tensors="pt").to("cuda")
-        outputs = self.model.generate(inputs)
-        final_output = self.tokenizer.decode(outputs[0], skip_special_tokens=True)[-2:]
-        return "no" in final_output
+        return self.abstract([word])[0][0]
 
     def get_words(self) -> list:
         return self.words
@@ -37,6 +58,9 @@ class TransFilter:
     def get_abstract_vs_concrete_dict(self) -> dict:
         return self.abstract_vs_concrete_dict
 
+    def get_abstract_probabilities(self) -> dict:
+        return self.abstract_probabilities
+
 
 def get_concreteness_from_file(file_name: str):
     """
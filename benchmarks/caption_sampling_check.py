@@ -0,0 +1,79 @@
+"""
+Checks that the seeded sampling of the captions (SeededNucleusSampling) draws from the same distribution as the
+sampling of BlipCaption.generate with nucleus sampling, i.e. generate(do_sample=True, top_p=0.9) and its default
+top-k warper, so the captions (and their scores) stay comparable with the runs made before it.
+For logits of several shapes, both samplers draw many tokens and their frequencies are compared with the
+probabilities of transformers' own warpers; the check fails when a sampler leaves the filtered tokens or drifts
+further from them than sampling noise:
+
+python3 benchmarks/caption_sampling_check.py --samples 20000
+"""
+import argparse
+import os
+import sys
+
+import torch
+from transformers.generation.logits_process import TopKLogitsWarper, TopPLogitsWarper
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from interrogate_images import SeededNucleusSampling, caption_seed  # noqa: E402
+
+# Vocabulary of BLIP's BERT tokenizer
+VOCABULARY = 30524
+
+
+def baseline_probabilities(logits: torch.Tensor, top_k: int = 50, top_p: float = 0.9) -> torch.Tensor:
+    """
+    Returns the distribution generate(do_sample=True, top_p=top_p) samples from, for logits already processed
+    """
+    scores = TopPLogitsWarper(top_p)(None, TopKLogitsWarper(top_k)(None, logits[None]))
+    return scores.softmax(dim=-1)[0]
+
+
+def seeded_samples(logits: torch.Tensor, samples: int, batch_size: int = 1000) -> torch.Tensor:
+    """
+    Draws samples tokens from logits with SeededNucleusSampling, one seed per row as in caption_images
+    """
+    tokens = []
+    for start in range(0, samples, batch_size):
+        seeds = [caption_seed("check", sample, 0) for sample in range(start, min(start + batch_size, samples))]
+        tokens.append(SeededNucleusSampling(seeds)(None, logits.expand(len(seeds), -1)).argmax(dim=-1))
+    return torch.cat(tokens)
+
+
+def distance(samples: torch.Tensor, probabilities: torch.Tensor) -> float:
+    """
+    Total variation distance between the frequencies of samples and probabilities
+    """
+    frequencies = torch.bincount(samples, minlength=len(probabilities)).double() / len(samples)
+    return 0.5 * (frequencies - probabilities.double()).abs().sum().item()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Distribution check of the seeded caption sampling")
+    parser.add_argument("--samples", type=int, default=20000)
+    args = parser.parse_args()
+
+    generator = torch.Generator().manual_seed(0)
+    # From flat logits (top-k keeps fewer tokens than top-p) to peaked ones (top-p keeps fewer than top-k)
+    cases = {f"temperature {temperature}": torch.randn(VOCABULARY, generator=generator) * temperature
+             for temperature in (0.5, 2.0, 4.0, 8.0)}
+    failed = False
+    for name, logits in cases.items():
+        probabilities = baseline_probabilities(logits)
+        seeded = seeded_samples(logits, args.samples)
+        reference = torch.multinomial(probabilities, args.samples, replacement=True, generator=generator)
+        outside = int((probabilities[seeded] == 0).sum())
+        seeded_distance, reference_distance = distance(seeded, probabilities), distance(reference, probabilities)
+        # Sampling noise alone leaves the multinomial draws of the baseline that far from its probabilities
+        ok = outside == 0 and seeded_distance <= 1.5 * reference_distance + 0.01
+        failed |= not ok
+        print(f"{name}: {int((probabilities > 0).sum())} tokens kept, {outside} samples outside of them, "
+              f"distance {seeded_distance:.4f} (baseline sampling {reference_distance:.4f}) "
+              f"{'OK' if ok else 'MISMATCH'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Benchmarks the CPU backend of YesNoJudge (int8 linear layers) on the prompt of the term extractor's TransFilter,
+and reports its accuracy drift against the verdicts of the checkpoint's own precision (fp16 for OPT) kept in
+cache/llm_verdicts.sqlite by the GPU runs. Without such verdicts, the reference is judged first with the gpu backend
+on the words of Ogden's Basic English list (and cached for the next runs):
+
+python3 benchmarks/judge_backend_benchmark.py --checkpoint facebook/opt-6.7b --words 500 --threads 32
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "term_extractor"))
+
+from llm_judge import VerdictCache, YesNoJudge  # noqa: E402
+from transformers_filter import TEMPLATE  # noqa: E402
+
+WORDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "term_extractor", "ogden.txt")
+
+
+def reference_verdicts(checkpoint: str, words: int, batch_size: int) -> dict:
+    """
+    Returns {word: probability of "yes"} of the gpu backend for at most words words
+    """
+    reference = VerdictCache().get(checkpoint, TEMPLATE)
+    if reference:
+        print(f"{len(reference)} cached verdicts of {checkpoint}")
+        return dict(sorted(reference.items())[:words])
+    print(f"No cached verdicts of {checkpoint}: judging the reference with the gpu backend")
+    with open(WORDS_PATH, "r") as f:
+        unique = list(dict.fromkeys(word.strip() for word in f.read().split(",") if word.strip()))[:words]
+    judge = YesNoJudge(checkpoint, TEMPLATE, batch_size=batch_size, backend="gpu")
+    return dict(zip(unique, judge.yes_probabilities(unique)))
+
+
+def drift_report(reference: dict, probabilities: dict, examples: int = 10) -> None:
+    """
+    Prints how far the probabilities of "yes" of the judge drift from the reference ones, and the verdicts they flip
+    """
+    differences = sorted((abs(probabilities[word] - p), word) for word, p in reference.items())
+    flipped = [word for word, p in reference.items() if (p > 0.5) != (probabilities[word] > 0.5)]
+    print(f"verdicts: {len(reference) - len(flipped)}/{len(reference)} agree "
+          f"({100 * (1 - len(flipped) / len(reference)):.2f}%), {len(flipped)} flipped")
+    print(f"|difference| of the probabilities: mean {sum(d for d, _ in differences) / len(differences):.4f}, "
+          f"median {differences[len(differences) // 2][0]:.4f}, max {differences[-1][0]:.4f} ({differences[-1][1]})")
+    for word in flipped[:examples]:
+        print(f"    flipped {word}: {reference[word]:.3f} -> {probabilities[word]:.3f}")
+    if len(flipped) > examples:
+        print(f"    ... and {len(flipped) - examples} more")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Throughput and accuracy drift of the CPU int8 LLM judge")
+    parser.add_argument("--checkpoint", default="facebook/opt-6.7b")
+    parser.add_argument("--words", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--threads", type=int, default=None, help="Threads of the CPU backend (all cores by default)")
+    args = parser.parse_args()
+
+    reference = reference_verdicts(args.checkpoint, args.words, args.batch_size)
+    words = list(reference)
+    # Verdicts are not cached, so every word reaches the model
+    judge = YesNoJudge(args.checkpoint, TEMPLATE, batch_size=args.batch_size, cache=False, backend="cpu-int8",
+                       threads=args.threads or os.cpu_count())
+    start = time.perf_counter()
+    # Loads the model, apart from the timing of the judge
+    judge.model
+    print(f"loading and quantizing {args.checkpoint}: {time.perf_counter() - start:.1f} s, "
+          f"{torch.get_num_threads()} threads")
+    # The first batch also computes the key/values of the prefix
+    judge.yes_probabilities(words[:args.batch_size])
+    start = time.perf_counter()
+    probabilities = dict(zip(words, judge.yes_probabilities(words)))
+    elapsed = time.perf_counter() - start
+    print(f"cpu-int8: {elapsed:.3f} s, {len(words) / elapsed:.1f} words/s, {1000 * elapsed / len(words):.1f} ms/word")
+    drift_report(reference, probabilities)
+
+
+if __name__ == "__main__":
+    main()
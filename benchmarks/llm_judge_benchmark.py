@@ -0,0 +1,64 @@
+"""
+Benchmarks YesNoJudge with and without the reuse of the key/values of the few-shot prefix, on the words of Ogden's
+Basic English list and the prompt of the term extractor's TransFilter (verdicts are not cached, so both runs judge
+every word), and checks that both give the same probabilities:
+
+python3 benchmarks/llm_judge_benchmark.py --checkpoint facebook/opt-125m --words 500
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "term_extractor"))
+
+from llm_judge import YesNoJudge  # noqa: E402
+from transformers_filter import TEMPLATE  # noqa: E402
+
+WORDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "term_extractor", "ogden.txt")
+
+
+def prompt_tokens(judge: YesNoJudge, words: list) -> int:
+    """
+    Returns the number of tokens judge runs through the model for words, padding excluded
+    """
+    state = judge._prefix() if judge.reuse_prefix else False
+    if not state:
+        return sum(len(judge.tokenizer(judge.template.format(word=word)).input_ids) for word in words)
+    return state[1] + sum(len(judge.tokenizer(state[0].format(word=word), add_special_tokens=False).input_ids)
+                          for word in words)
+
+
+def timed(label: str, judge: YesNoJudge, words: list) -> list:
+    start = time.perf_counter()
+    probabilities = judge.yes_probabilities(words)
+    elapsed = time.perf_counter() - start
+    tokens = prompt_tokens(judge, words)
+    print(f"{label:<20} {elapsed:8.3f} s  {len(words) / elapsed:10.1f} words/s  {tokens / elapsed:10.1f} tokens/s  "
+          f"{tokens / len(words):6.1f} tokens/word")
+    return probabilities
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Few-shot prefix reuse benchmark of the yes/no LLM judge")
+    parser.add_argument("--checkpoint", default="facebook/opt-125m")
+    parser.add_argument("--words", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    with open(WORDS_PATH, "r") as f:
+        words = [word.strip() for word in f.read().split(",") if word.strip()][:args.words]
+    full = YesNoJudge(args.checkpoint, TEMPLATE, batch_size=args.batch_size, cache=False, reuse_prefix=False)
+    reuse = YesNoJudge(args.checkpoint, TEMPLATE, batch_size=args.batch_size, cache=False)
+    # Loads the model (shared by both judges) and warms it up before timing
+    full.yes_probabilities(words[:args.batch_size])
+    expected = timed("full prompts", full, words)
+    probabilities = timed("reused prefix", reuse, words)
+    if not reuse.prefix_state:
+        print("The prefix cannot be reused with this tokenizer: both runs judged the full prompts")
+    print(f"max |difference| of the probabilities: {max(abs(a - b) for a, b in zip(expected, probabilities)):.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Benchmarks the orchestration overhead of ImageGenerator.generate_images (scheduling, prompt embedding cache,
+image encoding, manifest and resume logic) with the synthetic diffusion backend, so it runs on any CPU machine:
+
+python3 benchmarks/orchestration_benchmark.py --prompts 200 --format png
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from functools import partial
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from diffusion_backends import FakeDiffusionBackend  # noqa: E402
+from image_generator import IMAGES_PER_PROMPT, ImageGenerator  # noqa: E402
+from image_writer import ImageWriter  # noqa: E402
+from sharded_generation import build_image_generator, generate_sharded  # noqa: E402
+
+
+def timed(label: str, images: int, function) -> None:
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    if images:
+        print(f"{label:<28} {elapsed:8.3f} s  {images / elapsed:10.1f} images/s  "
+              f"{1000 * elapsed / images:8.3f} ms/image")
+    else:
+        print(f"{label:<28} {elapsed:8.3f} s")
+
+
+def run_serial(prompts: list, image_format: str, batch_size: int) -> None:
+    with ImageWriter(image_format=image_format) as writer:
+        ig = ImageGenerator(prompts, folder_name="output_middle", writer=writer, device="cpu",
+                            backend=FakeDiffusionBackend())
+        ig.generate_images(steps=30, batch_size=batch_size)
+        ig.close()
+
+
+def simulate_crash(fraction: float) -> int:
+    """
+    Drops the last fraction of the manifest, as if the run had been killed, and returns the number of dropped images
+    """
+    with open("output_middle.manifest.jsonl", "r") as f:
+        lines = f.readlines()
+    keep = int(len(lines) * (1 - fraction))
+    with open("output_middle.manifest.jsonl", "w") as f:
+        f.writelines(lines[:keep])
+    return len(lines) - keep
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Orchestration benchmark with the synthetic diffusion backend")
+    parser.add_argument("--prompts", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--format", choices=["png", "webp"], default="png")
+    parser.add_argument("--workers", type=int, default=2, help="Worker processes of the sharded run")
+    args = parser.parse_args()
+
+    prompts = [f"concept {k},synonym {k}" for k in range(args.prompts)]
+    images = args.prompts * IMAGES_PER_PROMPT
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        timed("fresh run", images, lambda: run_serial(prompts, args.format, args.batch_size))
+        timed("no-op resume", 0, lambda: run_serial(prompts, args.format, args.batch_size))
+        dropped = simulate_crash(0.25)
+        timed("resume after crash", dropped, lambda: run_serial(prompts, args.format, args.batch_size))
+        os.chdir(tempfile.mkdtemp(dir=workdir))
+        factory = partial(build_image_generator, image_format=args.format, backend="fake")
+        timed(f"sharded, {args.workers} workers", images,
+              lambda: generate_sharded({"output_middle": prompts}, ["cpu"] * args.workers, factory=factory,
+                                       batch_size=args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
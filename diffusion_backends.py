@@ -0,0 +1,224 @@
+import hashlib
+import time
+from abc import ABC, abstractmethod
+
+import torch
+from PIL import Image
+
+from model_registry import diffusion_pipeline
+
+
+class DiffusionBackend(ABC):
+    """
+    Interface between ImageGenerator and the model that actually renders the images.
+    A backend encodes prompts into embeddings (cached by PromptEmbeddingCache) and renders
+    one image per (prompt embedding, seed) pair.
+    A backend must implement tokenizer_id, encode_text, denoise and decode.
+    """
+    weights = None
+    device = "cpu"
+    dtype = torch.float32
+    latent_shape = (4, 64, 64)
+
+    def load(self) -> None:
+        """
+        Loads the model, called once before the first prompt is encoded
+        """
+
+    @abstractmethod
+    def tokenizer_id(self) -> str:
+        """
+        Identifies the tokenizer, part of the key of the cached prompt embeddings
+        """
+
+    @abstractmethod
+    def encode_text(self, texts: list) -> torch.Tensor:
+        """
+        Returns the (len(texts), tokens, hidden) embeddings of texts
+        """
+
+    @abstractmethod
+    def denoise(self, prompt_embeds: torch.Tensor, negative_prompt_embeds: torch.Tensor, seeds: list, steps: int,
+                guidance_scale: float) -> torch.Tensor:
+        """
+        Runs the diffusion loop and returns the final (len(seeds), *latent_shape) latents,
+        the i-th one being seeded with seeds[i]
+        """
+
+    @abstractmethod
+    def decode(self, latents) -> list:
+        """
+        Decodes latents (a tensor or a numpy array) into PIL images
+        """
+
+    def render(self, prompt_embeds: torch.Tensor, negative_prompt_embeds: torch.Tensor, seeds: list, steps: int,
+               guidance_scale: float) -> list:
+        """
+        Renders one PIL image per prompt embedding, the i-th image being seeded with seeds[i]
+        """
+        return self.decode(self.denoise(prompt_embeds, negative_prompt_embeds, seeds, steps, guidance_scale))
+
+
+class StableDiffusionBackend(DiffusionBackend):
+    """
+    Stable Diffusion through diffusers, in fp16 on a CUDA device with xformers attention
+    """
+
+    def __init__(self, weights: str = "runwayml/stable-diffusion-v1-5", device: str = "cuda") -> None:
+        # The user needs to be logged-in with huggingface-cli
+        # weights = "stabilityai/stable-diffusion-2-1-base"
+        self.weights = weights
+        self.device = device
+        self.dtype = torch.float16
+
+    @property
+    def pipe(self):
+        # Held by the model registry, so it counts in its memory budget and is loaded once per process
+        return diffusion_pipeline(self.weights, self.device, self.dtype, self._load_pipeline)
+
+    def load(self) -> None:
+        self.warmup_pass()
+
+    def _load_pipeline(self):
+        from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
+        torch.backends.cudnn.benchmark = True  # enabling cuDNN auto-tuner for faster convolution
+        pipe = StableDiffusionPipeline.from_pretrained(
+            self.weights,
+            device_map="auto",
+            safety_checker=None,
+            revision="fp16",
+            torch_dtype=torch.float16)
+        pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+        pipe = pipe.to(self.device)
+        pipe.enable_attention_slicing()
+        pipe.enable_xformers_memory_efficient_attention()
+        return pipe
+
+    def warmup_pass(self):
+        """
+        Warmup pass to initialize the model
+        """
+        fake_prompt = "A photo of an astronaut riding a horse on mars"
+        self.pipe(fake_prompt, num_inference_steps=1)
+        print("Warmup pass complete || READY TO GENERATE IMAGES")
+
+    def tokenizer_id(self) -> str:
+        tokenizer = self.pipe.tokenizer
+        return f"{type(tokenizer).__name__}:{tokenizer.name_or_path}:{len(tokenizer)}:{tokenizer.model_max_length}"
+
+    @torch.no_grad()
+    def encode_text(self, texts: list) -> torch.Tensor:
+        """
+        Encodes texts the same way StableDiffusionPipeline does
+        """
+        tokenizer, text_encoder = self.pipe.tokenizer, self.pipe.text_encoder
+        tokens = tokenizer(texts,
+                           padding="max_length",
+                           max_length=tokenizer.model_max_length,
+                           truncation=True,
+                           return_tensors="pt")
+        attention_mask = None
+        if getattr(text_encoder.config, "use_attention_mask", False):
+            attention_mask = tokens.attention_mask.to(text_encoder.device)
+        return text_encoder(tokens.input_ids.to(text_encoder.device), attention_mask=attention_mask)[0]
+
+    def render(self, prompt_embeds, negative_prompt_embeds, seeds, steps, guidance_scale) -> list:
+        return self._run(prompt_embeds, negative_prompt_embeds, seeds, steps, guidance_scale, "pil")
+
+    def denoise(self, prompt_embeds, negative_prompt_embeds, seeds, steps, guidance_scale) -> torch.Tensor:
+        return self._run(prompt_embeds, negative_prompt_embeds, seeds, steps, guidance_scale, "latent")
+
+    def _run(self, prompt_embeds, negative_prompt_embeds, seeds, steps, guidance_scale, output_type):
+        generators = [torch.Generator(device=self.device).manual_seed(seed) for seed in seeds]
+        return self.pipe(prompt_embeds=prompt_embeds,
+                         negative_prompt_embeds=negative_prompt_embeds,
+                         num_inference_steps=steps,
+                         generator=generators,
+                         guidance_scale=guidance_scale,
+                         num_images_per_prompt=1,
+                         output_type=output_type).images
+
+    @torch.no_grad()
+    def decode(self, latents) -> list:
+        latents = torch.as_tensor(latents).to(self.device, dtype=self.dtype)
+        images = self.pipe.vae.decode(latents / self.pipe.vae.config.scaling_factor, return_dict=False)[0]
+        return self.pipe.image_processor.postprocess(images, output_type="pil")
+
+
+class CPUDiffusionBackend(StableDiffusionBackend):
+    """
+    Stable Diffusion through diffusers on the CPU, in fp32 (slow, but runs without a GPU)
+    """
+
+    def __init__(self, weights: str = "runwayml/stable-diffusion-v1-5", threads: int = None) -> None:
+        super().__init__(weights, device="cpu")
+        self.dtype = torch.float32
+        self.threads = threads
+
+    def load(self) -> None:
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        # Loads the pipeline
+        self.pipe
+
+    def _load_pipeline(self):
+        from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
+        pipe = StableDiffusionPipeline.from_pretrained(self.weights, safety_checker=None, torch_dtype=torch.float32)
+        pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+        pipe = pipe.to(self.device)
+        pipe.enable_attention_slicing()
+        return pipe
+
+
+class FakeDiffusionBackend(DiffusionBackend):
+    """
+    Synthetic backend for tests and orchestration benchmarks: no model, no GPU.
+    Embeddings are derived from the text hash and every image is blocky noise decoded from seeded random latents,
+    so the output is deterministic and the time spent in the backend is negligible (or exactly seconds_per_image).
+    """
+
+    def __init__(self, size: int = 512, seconds_per_image: float = 0.0) -> None:
+        self.weights = "fake"
+        self.size = size
+        self.latent_shape = (4, size // 32, size // 32)
+        self.seconds_per_image = seconds_per_image
+
+    def tokenizer_id(self) -> str:
+        return "fake"
+
+    def encode_text(self, texts: list) -> torch.Tensor:
+        seeds = [int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big") >> 1 for text in texts]
+        return torch.stack([torch.randn(77, 8, generator=torch.Generator().manual_seed(seed)) for seed in seeds])
+
+    def denoise(self, prompt_embeds, negative_prompt_embeds, seeds, steps, guidance_scale) -> torch.Tensor:
+        if self.seconds_per_image:
+            time.sleep(self.seconds_per_image * len(seeds))
+        return torch.stack([torch.randn(self.latent_shape, generator=torch.Generator().manual_seed(seed))
+                            for seed in seeds]).to(torch.float16)
+
+    def decode(self, latents) -> list:
+        # The first three latent channels become the colors of a blocky image
+        pixels = ((torch.as_tensor(latents, dtype=torch.float32)[:, :3].clamp(-2, 2) + 2) * 63.75).to(torch.uint8)
+        return [Image.fromarray(block.permute(1, 2, 0).numpy()).resize((self.size, self.size), Image.NEAREST)
+                for block in pixels]
+
+
+BACKENDS = {
+    "sd": StableDiffusionBackend,
+    "cpu": CPUDiffusionBackend,
+    "fake": FakeDiffusionBackend,
+}
+
+
+def get_backend(name: str, device: str = None) -> DiffusionBackend:
+    """
+    Builds the backend called name ("sd", "cpu" or "fake"), on device when the backend has a choice.
+    The cpu backend only runs on the CPU, and refuses any other device.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown diffusion backend: {name}. Please use one of {', '.join(BACKENDS)}.")
+    if name == "cpu" and device is not None and torch.device(device).type != "cpu":
+        raise ValueError(f"The cpu diffusion backend cannot run on {device}, please use the sd backend.")
+    if name == "sd" and device is not None:
+        return StableDiffusionBackend(device=device)
+    return BACKENDS[name]()
@@ -1,13 +1,22 @@
+import hashlib
+import json
 import os
+import threading
+import time
 
-from sentence_transformers import util, SentenceTransformer
+import torch
+
+from progress_index import ProgressIndex
+from results_store import ResultsStore, set_name
+from sentence_embedding_cache import SENTENCE_MODEL, SentenceEmbeddingCache
+from telemetry import Stage
 
 
 class Evaluation:
     def __init__(self, generated_phrases_path_folder: str):
         self.generated_phrases_path = generated_phrases_path_folder
         self.folder_names = self.prepare_folder_names()
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
+        self.embeddings = SentenceEmbeddingCache(None, SENTENCE_MODEL)
         self.cosine_scores = self.compute_cosine_scores()
 
     def prepare_folder_names(self):
@@ -40,12 +49,212 @@ class Evaluation:
 
     def compute_cosine_scores(self):
         """
-        Compute the cosine similarity between the generated phrases and the folder name
+        Compute the cosine similarity between the generated phrases and the folder name.
+        All the phrases and folder names are encoded together through the embedding cache,
+        so the captions already embedded during the interrogation are not encoded again.
+        """
+        return dict(zip(self.folder_names, score_phrases(self.embeddings, list(self.folder_names.items()))))
+
+
+def score_phrases(embeddings: SentenceEmbeddingCache, concepts: list) -> list:
+    """
+    Given a list of (concept name, list of phrases) pairs, returns for each concept the list of
+    cosine similarities between its phrases and its name.
+    Every phrase and every distinct name is encoded in one pass of the embedding cache, then all the scores
+    come from a single row-wise dot product between the normalized phrase and name embeddings.
+    """
+    name_row = {name: row for row, name in enumerate(dict.fromkeys(name for name, _ in concepts))}
+    names = list(name_row)
+    phrases = [phrase for _, concept_phrases in concepts for phrase in concept_phrases]
+    if not phrases:
+        return [[] for _ in concepts]
+    vectors = torch.nn.functional.normalize(embeddings.encode(names + phrases), dim=1)
+    name_rows = torch.tensor([name_row[name] for name, concept_phrases in concepts for _ in concept_phrases])
+    scores = (vectors[len(names):] * vectors[name_rows]).sum(dim=1).tolist()
+    split = []
+    start = 0
+    for _, concept_phrases in concepts:
+        split.append(scores[start:start + len(concept_phrases)])
+        start += len(concept_phrases)
+    return split
+
+
+class CorpusEvaluation:
+    """
+    Scores the interrogations of every concept folder of several output folders (e.g. output_middle and
+    output_advanced) in one batched pass, see score_phrases, and stores captions and scores in a ResultsStore.
+    The sha256 of each interrogations.txt that has been scored is kept in <output folder>.scores.json,
+    so a rerun only scores the folders whose interrogations changed or that are missing from the store.
+    With text_files, every concept folder also gets its cosine_scores.txt, as written by Evaluation.
+    An existing embedding cache (e.g. the one of an ImageInterrogator) can be shared instead of opening another one.
+    """
+
+    def __init__(self, output_folders: list, batch_size: int = 256, results_path: str = "results.npz",
+                 text_files: bool = False, embeddings: SentenceEmbeddingCache = None) -> None:
+        self.output_folders = output_folders
+        if embeddings is None:
+            # MiniLM is only loaded if some caption or concept name is not in the embedding cache
+            embeddings = SentenceEmbeddingCache(None, SENTENCE_MODEL, batch_size=batch_size)
+        self.embeddings = embeddings
+        self.results = ResultsStore(results_path)
+        self.progress = ProgressIndex()
+        self.text_files = text_files
+        self.cosine_scores = {}
+        # Guards self.results when folders are scored by score_stream in another thread
+        self.lock = threading.Lock()
+        # Exception raised in score_stream, if any
+        self.stream_error = None
+
+    @staticmethod
+    def _state_path(output_folder: str) -> str:
+        return f"{os.path.normpath(output_folder)}.scores.json"
+
+    def _load_state(self, output_folder: str) -> dict:
+        if not os.path.exists(self._state_path(output_folder)):
+            return {}
+        with open(self._state_path(output_folder), "r") as f:
+            return json.load(f)
+
+    def dirty_folders(self) -> list:
+        """
+        Returns the (output folder, concept folder, interrogations digest) of the interrogated concept folders
+        that need to be scored
+        """
+        dirty = []
+        for output_folder in self.output_folders:
+            state = self._load_state(output_folder)
+            for folder in sorted(os.listdir(output_folder)):
+                interrogations = os.path.join(output_folder, folder, "interrogations.txt")
+                if not os.path.exists(interrogations):
+                    continue
+                with open(interrogations, "rb") as f:
+                    content = f.read()
+                # Folders without captions have nothing to score
+                if not content:
+                    continue
+                digest = hashlib.sha256(content).hexdigest()
+                if (state.get(folder) != digest or not self.results.has(set_name(output_folder), folder)
+                        or self.text_files and not os.path.exists(os.path.join(output_folder, folder,
+                                                                               "cosine_scores.txt"))):
+                    dirty.append((output_folder, folder, digest))
+        return dirty
+
+    def evaluate(self) -> None:
+        """
+        Scores the dirty concept folders, stores their results and records their digests
+        """
+        dirty = self.dirty_folders()
+        if not dirty:
+            print("Nothing to evaluate")
+            return
+        with Stage("evaluate") as stage:
+            captions = []
+            for output_folder, folder, _ in dirty:
+                with open(os.path.join(output_folder, folder, "interrogations.txt"), "r") as f:
+                    captions.append(f.readlines())
+            concepts = [(folder.replace('_', ' ').replace('-', ','), folder_captions)
+                        for (_, folder, _), folder_captions in zip(dirty, captions)]
+            try:
+                scored = score_phrases(self.embeddings, concepts)
+            except Exception as error:
+                for output_folder in self.output_folders:
+                    self.progress.failed("evaluate", output_folder,
+                                         [folder for dirty_output_folder, folder, _ in dirty
+                                          if dirty_output_folder == output_folder], error)
+                raise
+            for (output_folder, folder, _), folder_captions, scores in zip(dirty, captions, scored):
+                self.cosine_scores[(output_folder, folder)] = scores
+                self.results.update(set_name(output_folder), folder, folder_captions, scores)
+            self.flush(dirty)
+            stage.item(count=len(dirty))
+
+    def is_scored(self, output_folder: str, folder: str) -> bool:
+        with self.lock:
+            return self.results.has(set_name(output_folder), folder)
+
+    def score_stream(self, interrogations, flush_every: int = 200, flush_seconds: float = 120.0) -> None:
+        """
+        Scores the (output folder, concept folder, captions, caption embeddings) items of the interrogations queue
+        until it gets None, reusing the embeddings computed by the interrogator to pick the captions.
+        Every flush rewrites the whole results store, so the results are written every flush_every concepts
+        or flush_seconds seconds, whichever comes first, and once at the end: a crash loses at most that much scoring.
+        """
+        scored = []
+        last_flush = time.perf_counter()
+        item = None
+        finished = False
+        try:
+            with Stage("score-stream") as stage:
+                while True:
+                    stage.queue_depth(interrogations.qsize())
+                    item = interrogations.get()
+                    if item is None:
+                        finished = True
+                        break
+                    output_folder, folder, captions, caption_embeddings = item
+                    scores = []
+                    if captions:
+                        name_embedding = self.embeddings.encode([folder.replace('_', ' ').replace('-', ',')])
+                        scores = (torch.nn.functional.normalize(caption_embeddings, dim=1)
+                                  * torch.nn.functional.normalize(name_embedding, dim=1)).sum(dim=1).tolist()
+                    with self.lock:
+                        self.cosine_scores[(output_folder, folder)] = scores
+                        self.results.update(set_name(output_folder), folder, captions, scores)
+                    # Same digest as the interrogations.txt of these captions
+                    digest = hashlib.sha256("".join(f"{caption}\n" for caption in captions).encode("utf-8")).hexdigest()
+                    scored.append((output_folder, folder, digest))
+                    stage.item()
+                    if len(scored) >= flush_every or time.perf_counter() - last_flush >= flush_seconds:
+                        self.flush(scored)
+                        scored = []
+                        last_flush = time.perf_counter()
+                self.flush(scored)
+        except BaseException as error:
+            self.stream_error = error
+            if item is not None:
+                self.progress.failed("evaluate", item[0], [item[1]], error)
+            # Keep draining the queue until the end of the stream (unless it was already reached),
+            # so the interrogator never blocks on it
+            while not finished and interrogations.get() is not None:
+                pass
+
+    def flush(self, scored: list) -> None:
+        """
+        Writes the results, the text files and the digests of the (output folder, concept folder, digest)
+        that have just been scored
+        """
+        if not scored:
+            return
+        with self.lock:
+            self.results.save()
+        if self.text_files:
+            self.print_to_file(scored)
+        self.save_state(scored)
+        for output_folder in self.output_folders:
+            self.progress.done("evaluate", output_folder,
+                               [folder for scored_output_folder, folder, _ in scored
+                                if scored_output_folder == output_folder])
+
+    def print_to_file(self, dirty: list) -> None:
+        """
+        Writes the cosine_scores.txt of the scored folders (same format as Evaluation.print_to_file)
+        """
+        for output_folder, folder, _ in dirty:
+            scores = self.cosine_scores[(output_folder, folder)]
+            if scores:
+                with open(os.path.join(output_folder, folder, "cosine_scores.txt"), "w") as f:
+                    for score in scores:
+                        f.write(f"{score}\n")
+                    f.write(f"Mean: {sum(scores) / len(scores)}\n")
+
+    def save_state(self, dirty: list) -> None:
+        """
+        Records the digests of the interrogations that have just been scored
         """
-        cosine_scores = {}
-        for folder, phrases in self.folder_names.items():
-            cosine_scores[folder] = []
-            for i, p in enumerate(phrases):
-                cosine_scores[folder].append(util.cos_sim(self.model.encode(p, convert_to_tensor=True),
-                                                          self.model.encode(folder, convert_to_tensor=True)).item())
-        return cosine_scores
+        for output_folder in self.output_folders:
+            state = self._load_state(output_folder)
+            state.update({folder: digest for scored_output_folder, folder, digest in dirty
+                          if scored_output_folder == output_folder})
+            with open(f"{self._state_path(output_folder)}.tmp", "w") as f:
+                json.dump(state, f)
+            os.replace(f"{self._state_path(output_folder)}.tmp", self._state_path(output_folder))
@@ -0,0 +1,136 @@
+import json
+import os
+import threading
+
+from image_writer import IMAGE_EXTENSIONS
+
+
+def image_key(image: str) -> str:
+    """
+    Returns the number in its concept of an image named "{j}", or "{i}_{j}" by the former runs
+    """
+    return image.rsplit("_", 1)[-1]
+
+
+class GenerationManifest:
+    """
+    Append-only record of the images that are completely on disk for one output folder.
+    Every line is a json object {"concept": subfolder, "image": "{j}", "file": file name}, appended only after
+    the image has been atomically renamed into place, so a crash can never mark a missing image as done.
+    Images are keyed by their number j in the concept folder: the entries of the runs that named them "{i}_{j}",
+    after the position i of their prompt in the list, count as image j of the concept.
+    The manifest lives next to the output folder (output_middle.manifest.jsonl), not inside it,
+    because the later stages treat every entry of the output folder as a concept.
+    """
+
+    def __init__(self, folder_name: str) -> None:
+        self.folder_name = folder_name
+        self.path = f"{os.path.normpath(folder_name)}.manifest.jsonl"
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            self.completed = self._read()
+        else:
+            self.completed = set()
+            self._adopt_existing_images()
+        self.file = open(self.path, "a")
+        if self.file.tell() > 0 and not self._ends_with_newline():
+            # Terminate a truncated last line, so the next record starts on a line of its own
+            self.file.write("\n")
+
+    def _ends_with_newline(self) -> bool:
+        with open(self.path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def _read(self) -> set:
+        return self._read_manifest(self.path)
+
+    @staticmethod
+    def _read_manifest(path: str) -> set:
+        completed = set()
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash in the middle of an append leaves a truncated last line: that image is simply redone
+                    continue
+                completed.add((entry["concept"], image_key(entry["image"])))
+        return completed
+
+    def _adopt_existing_images(self) -> None:
+        """
+        One-time migration of output folders generated before the manifest existed:
+        the images already on disk are recorded, empty or partial folders are left to be completed.
+        Those runs named the images of a concept "{i}_{j}", i counting the prompts rendered by the run (not the
+        position of the prompt in the list), so an image is adopted as image j of its concept folder.
+        """
+        with open(self.path, "a") as f:
+            for concept, image, file_name in self._scan_images(self.folder_name):
+                self.completed.add((concept, image))
+                f.write(json.dumps({"concept": concept, "image": image, "file": file_name}) + "\n")
+
+    @staticmethod
+    def _scan_images(folder_name: str) -> list:
+        """
+        Returns the (concept, image number, file name) of the images on disk in folder_name
+        """
+        if not os.path.isdir(folder_name):
+            return []
+        images = []
+        for concept in sorted(os.listdir(folder_name)):
+            concept_path = os.path.join(folder_name, concept)
+            if not os.path.isdir(concept_path):
+                continue
+            for file_name in sorted(os.listdir(concept_path)):
+                image, extension = os.path.splitext(file_name)
+                if extension in IMAGE_EXTENSIONS:
+                    images.append((concept, image_key(image), file_name))
+        return images
+
+    @classmethod
+    def completed_images(cls, folder_name: str) -> set:
+        """
+        Returns the (concept, image) pairs done in folder_name without opening (or creating) its manifest,
+        for the tools that only inspect a run
+        """
+        path = f"{os.path.normpath(folder_name)}.manifest.jsonl"
+        if os.path.exists(path):
+            return cls._read_manifest(path)
+        return {(concept, image) for concept, image, _ in cls._scan_images(folder_name)}
+
+    @classmethod
+    def forget(cls, folder_name: str, concepts: set) -> None:
+        """
+        Removes every image of concepts from the manifest of folder_name, so they are rendered again.
+        No generator may have the manifest open meanwhile.
+        """
+        path = f"{os.path.normpath(folder_name)}.manifest.jsonl"
+        if not os.path.exists(path):
+            # Adopt the images on disk first, or they would all be adopted back
+            cls(folder_name).close()
+        with open(path, "r") as f, open(f"{path}.tmp", "w") as tmp:
+            for line in f:
+                try:
+                    if json.loads(line)["concept"] in concepts:
+                        continue
+                except json.JSONDecodeError:
+                    continue
+                tmp.write(line if line.endswith("\n") else line + "\n")
+        os.replace(f"{path}.tmp", path)
+
+    def is_done(self, concept: str, image: str) -> bool:
+        return (concept, image) in self.completed
+
+    def record(self, concept: str, image: str, file_name: str) -> None:
+        """
+        Appends a completed image to the manifest, flushing the line immediately
+        """
+        with self.lock:
+            self.completed.add((concept, image))
+            self.file.write(json.dumps({"concept": concept, "image": image, "file": file_name}) + "\n")
+            self.file.flush()
+
+    def close(self) -> None:
+        with self.lock:
+            self.file.close()
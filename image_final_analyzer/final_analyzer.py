@@ -1,43 +1,37 @@
 import os
+import sys
 
 import matplotlib.pyplot as plt
 import numpy as np
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from results_store import ResultsStore, set_name  # noqa: E402
+
 
 class FinalAnalyzer:
-    def __init__(self, folder_path_basic: str, folder_path_advanced: str):
+    def __init__(self, folder_path_basic: str, folder_path_advanced: str, results_path: str = "results.npz"):
         self.folder_path_basic = folder_path_basic
         self.folder_path_advanced = folder_path_advanced
+        self.results = ResultsStore(results_path)
         self.folder_names = self.prepare_folder()
 
     def prepare_folder(self):
+        """
+        Returns {set name: {concept name: mean cosine similarity}} for the basic and the advanced folder
+        """
+
         def process_folder_name(name):
             return name.replace('_', ' ').replace('-', ',')
 
-        folder_names = {}
-        for folder_path in (self.folder_path_basic, self.folder_path_advanced):
-            for folder in os.listdir(folder_path):
-                processed_folder_name = process_folder_name(folder)
-                with open(f"{folder_path}/{folder}/cosine_scores.txt", "r") as f:
-                    # Locate the line that has "Mean" in it
-                    # Since the line is "Mean: 0.123", we remove the first 6 chars
-                    for line in f.readlines():
-                        if "Mean" in line:
-                            folder_names[processed_folder_name] = float(line[6:])
-
-        return folder_names
+        return {set_name(folder_path): {process_folder_name(folder): score
+                                        for folder, score in self.results.mean_scores(set_name(folder_path)).items()}
+                for folder_path in (self.folder_path_basic, self.folder_path_advanced)}
 
     def plot_cosine_similarity(self):
-        basic_folders, advanced_folders, basic_scores, advanced_scores = [], [], [], []
-        for folder, score in self.folder_names.items():
-            if os.path.exists(
-                    f"{self.folder_path_basic}/{folder.replace(' ', '_').replace(',', '-')}/cosine_scores.txt"):
-                basic_folders.append(folder)
-                basic_scores.append(score)
-            elif os.path.exists(
-                    f"{self.folder_path_advanced}/{folder.replace(' ', '_').replace(',', '-')}/cosine_scores.txt"):
-                advanced_folders.append(folder)
-                advanced_scores.append(score)
+        basic = self.folder_names[set_name(self.folder_path_basic)]
+        advanced = self.folder_names[set_name(self.folder_path_advanced)]
+        basic_folders, basic_scores = list(basic), list(basic.values())
+        advanced_folders, advanced_scores = list(advanced), list(advanced.values())
         # Reorder the folders based on the scores (in a gaussian distribution)
         basic_folders = [x for _, x in sorted(zip(basic_scores, basic_folders))]
         basic_scores = sorted(basic_scores)
@@ -1,75 +1,257 @@
+import hashlib
 import os
+import threading
+import time
 
-import torch
-from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
 from tqdm import tqdm
 
+from diffusion_backends import DiffusionBackend, StableDiffusionBackend
+from generation_manifest import GenerationManifest
+from image_writer import ImageWriter
+from latent_store import LatentStore
+from progress_index import ProgressIndex
+from prompt_embedding_cache import PromptEmbeddingCache
+from telemetry import ModelCall, Stage
+
+SEED = 26111998
+NEGATIVE_PROMPT = "writing, letters, handwriting, words"
+IMAGES_PER_PROMPT = 5
+
+
+def image_seed(prompt: str, image_number: int, base_seed: int = SEED) -> int:
+    """
+    Derives the seed of a single image from the prompt text and the image number.
+    The seed does not depend on the position of the prompt in the list, nor on the batch it ends up in,
+    so the same prompt always produces the same images.
+    """
+    digest = hashlib.sha256(f"{base_seed}:{prompt}:{image_number}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") & 0x7FFFFFFFFFFFFFFF
+
+
+def folder_name_from_prompt(prompt: str) -> str:
+    return prompt.replace(' ', '_').replace(',', '-')
+
+
+def unique_prompts(prompt_list: list) -> list:
+    """
+    Returns the prompts of prompt_list that have a concept folder of their own, in order:
+    a prompt listed twice (or mapping to the folder of an earlier prompt) is a single concept, rendered once
+    """
+    concepts = {}
+    for prompt in prompt_list:
+        concepts.setdefault(folder_name_from_prompt(prompt), prompt)
+    return list(concepts.values())
+
+
+def concept_done(completed: set, concept: str) -> bool:
+    """
+    Returns whether all the images of concept are among the (concept, image) pairs completed
+    """
+    return all((concept, str(j)) in completed for j in range(IMAGES_PER_PROMPT))
+
+
+def pending_images(folder_name: str, prompt_list: list) -> int:
+    """
+    Returns the number of images of prompt_list that are missing from folder_name, reading only its manifest
+    """
+    completed = GenerationManifest.completed_images(folder_name)
+    return sum((folder_name_from_prompt(prompt), str(j)) not in completed
+               for prompt in unique_prompts(prompt_list) for j in range(IMAGES_PER_PROMPT))
+
 
 class ImageGenerator:
-    def __init__(self, prompt_list: list, folder_name="output") -> None:
+    def __init__(self, prompt_list: list, folder_name="output", writer: ImageWriter = None, device="cuda",
+                 backend: DiffusionBackend = None, store_latents=False, preload=False) -> None:
+        self.backend = backend if backend is not None else StableDiffusionBackend(device=device)
+        # The backend is loaded before the first image is rendered, so a folder with nothing left to render
+        # never loads it. With preload, it starts loading right away, while the manifest is read.
+        self.embedding_cache = None
+        self.loading = None
+        self.load_error = None
+        if preload:
+            self.preload_backend()
         self.prompt_list = prompt_list
+        self.writer = writer if writer is not None else ImageWriter()
         self._mkdir_if_not_exists(folder_name)
         self.folder_name = folder_name
-        # The user needs to be logged-in with huggingface-cli
-        self.generator = self._initialize_generator()
-        # weights = "stabilityai/stable-diffusion-2-1-base"
-        weights = "runwayml/stable-diffusion-v1-5"
-
-        torch.backends.cudnn.benchmark = True  # enabling cuDNN auto-tuner for faster convolution
-        self.pipe = StableDiffusionPipeline.from_pretrained(
-            weights,
-            device_map="auto",
-            safety_checker=None,
-            revision="fp16",
-            torch_dtype=torch.float16)
-        self.pipe.scheduler = DPMSolverMultistepScheduler.from_config(self.pipe.scheduler.config)
-        self.pipe = self.pipe.to("cuda")
-        self.pipe.enable_attention_slicing()
-        self.pipe.enable_xformers_memory_efficient_attention()
-        self.warmup_pass()
-
-    def warmup_pass(self):
-        """
-        Warmup pass to initialize the model
-        """
-        fake_prompt = "A photo of an astronaut riding a horse on mars"
-        self.pipe(fake_prompt, num_inference_steps=1)
-        print("Warmup pass complete || READY TO GENERATE IMAGES")
-
-    def generate_images(self, steps=30):
-        """
-        Generates images for each prompt in self.prompt_list
-        """
-        pbar = tqdm(self.prompt_list)
-        i = 1
-        for prompt in pbar:
-            # Don't generate if the folder already exists
-            subfolder_name = prompt.replace(' ', '_').replace(',', '-')
-            if not os.path.exists(f"{self.folder_name}/{subfolder_name}/"):
-                os.mkdir(f"{self.folder_name}/{subfolder_name}/")
-                pbar.set_description(f"Generating: {prompt}")
-                image = self.pipe(prompt,
-                                  negative_prompt="writing, letters, handwriting, words",
-                                  num_inference_steps=steps,
-                                  generator=self.generator,
-                                  guidance_scale=7.5,
-                                  num_images_per_prompt=5)
-                for j, img in enumerate(image.images):
-                    img.save(f"{self.folder_name}/{subfolder_name}/{i}_{j}.png")
-                i += 1
+        self.manifest = GenerationManifest(folder_name)
+        self.device = device
+        self.progress = ProgressIndex()
+        # Optionally keep the final latents, so images can be decoded again without denoising
+        self.store_latents = store_latents
+        self.latent_store = self._open_latent_store()
+        # Telemetry of the running generation, and the time the first batch of each incomplete concept started at
+        self.stage = None
+        self.started_at = {}
+        self.timing_lock = threading.Lock()
+
+    def generate_images(self, steps=30, batch_size=1):
+        """
+        Generates images for each concept of self.prompt_list, i.e. each prompt with a folder of its own.
+        batch_size prompts (IMAGES_PER_PROMPT images each) are packed in a single pipeline call;
+        every image has its own seed, so the output does not depend on batch_size or on the prompt order.
+        Images are handed to self.writer, which encodes them in the background while the next batch is denoised,
+        and each one is recorded in the manifest as soon as it is on disk.
+        The latency of a concept runs from the start of its first batch until its last image is on disk.
+        """
+        jobs = self._pending_jobs(unique_prompts(self.prompt_list))
+        if not jobs:
+            print(f"Nothing to generate in {self.folder_name}")
+            return
+        self.load_backend()
+        pbar = tqdm(total=len(jobs))
+        images_per_call = batch_size * IMAGES_PER_PROMPT
+        with Stage("generate", folder=self.folder_name, batch_size=batch_size, steps=steps) as self.stage:
+            try:
+                for start in range(0, len(jobs), images_per_call):
+                    batch = jobs[start:start + images_per_call]
+                    pbar.set_description(f"Generating: {batch[0][0]}")
+                    batch_start = time.perf_counter()
+                    with self.timing_lock:
+                        for prompt, _ in batch:
+                            self.started_at.setdefault(folder_name_from_prompt(prompt), batch_start)
+                    self._generate_batch(batch, steps)
+                    self.stage.queue_depth(self.writer.queue_depth())
+                    pbar.update(len(batch))
+                pbar.close()
+                self.writer.flush()
+            finally:
+                with self.timing_lock:
+                    self.stage = None
+                    self.started_at = {}
+
+    def generate_concepts(self, prompts: list, steps=30) -> None:
+        """
+        Renders the missing images of the concepts of prompts in the current folder
+        in a single pipeline call, used by the sharded generation workers
+        """
+        jobs = self._pending_jobs(prompts)
+        if jobs:
+            self.load_backend()
+            self._generate_batch(jobs, steps)
+
+    def preload_backend(self) -> None:
+        """
+        Starts loading the backend in a background thread
+        """
+        if self.loading is None:
+            self.loading = threading.Thread(target=self._load_backend, daemon=True)
+            self.loading.start()
+
+    def load_backend(self) -> None:
+        """
+        Loads the backend, or waits for the background load to end
+        """
+        self.preload_backend()
+        self.loading.join()
+        if self.load_error is not None:
+            raise self.load_error
+
+    def _load_backend(self) -> None:
+        try:
+            self.backend.load()
+            self.embedding_cache = PromptEmbeddingCache(self.backend)
+        except BaseException as error:
+            self.load_error = error
+
+    def _pending_jobs(self, prompts: list) -> list:
+        """
+        Returns the (prompt, image number) pairs of prompts that still have to be rendered,
+        reading only the manifest: a prompt interrupted halfway only gets its missing images rendered.
+        Images are named after their number in the concept folder, so they do not depend on the position
+        of the prompt in the list, and inserting or removing a prompt leaves the other concepts alone.
+        """
+        return [(prompt, j)
+                for prompt in prompts
+                for j in range(IMAGES_PER_PROMPT)
+                if not self.manifest.is_done(folder_name_from_prompt(prompt), str(j))]
+
+    def _generate_batch(self, batch: list, steps: int) -> None:
+        try:
+            with ModelCall(f"diffusion:{self.backend.weights}", len(batch)):
+                if self.latent_store is None:
+                    images = self._render(batch, steps)
+                else:
+                    latents = self._render(batch, steps, latents_only=True)
+                    self.latent_store.write([self.latent_store.row(folder_name_from_prompt(prompt), j)
+                                             for prompt, j in batch], latents)
+                    images = self.backend.decode(latents)
+        except Exception as error:
+            self.progress.failed("generate", self.folder_name,
+                                 sorted({folder_name_from_prompt(prompt) for prompt, _ in batch}), error)
+            raise
+        for (prompt, j), img in zip(batch, images):
+            self._save(img, folder_name_from_prompt(prompt), j)
+
+    def _save(self, img, concept: str, image_number: int) -> None:
+        os.makedirs(f"{self.folder_name}/{concept}", exist_ok=True)
+        manifest, progress, folder_name = self.manifest, self.progress, self.folder_name
+        image = str(image_number)
+
+        def on_saved(path):
+            manifest.record(concept, image, os.path.basename(path))
+            # The concept is done once all of its images are on disk
+            if all(manifest.is_done(concept, str(j)) for j in range(IMAGES_PER_PROMPT)):
+                progress.done("generate", folder_name, [concept])
+                self._concept_done(concept)
+
+        self.writer.submit(img, f"{self.folder_name}/{concept}/{image}", on_saved=on_saved)
+
+    def _concept_done(self, concept: str) -> None:
+        """
+        Counts a concept in the telemetry of the running generation, with its own latency.
+        Called by the writer threads when the last image of the concept is on disk: two images saved at the same time
+        may both see the concept complete, so it is only counted once.
+        """
+        with self.timing_lock:
+            started_at = self.started_at.pop(concept, None)
+            if self.stage is not None and started_at is not None:
+                self.stage.item(latency=time.perf_counter() - started_at)
+
+    def _render(self, batch: list, steps: int, latents_only=False):
+        """
+        Renders a batch of (prompt, image number) jobs in a single backend call,
+        returning the images or, with latents_only, the final latents
+        """
+        prompts = [prompt for prompt, _ in batch]
+        seeds = [image_seed(prompt, j) for prompt, j in batch]
+        # The text encoder only runs on prompts that are not in the embedding cache yet
+        prompt_embeds = self.embedding_cache.get(prompts)
+        negative_prompt_embeds = self.embedding_cache.get([NEGATIVE_PROMPT]).expand_as(prompt_embeds)
+        if latents_only:
+            return self.backend.denoise(prompt_embeds, negative_prompt_embeds, seeds, steps, guidance_scale=7.5)
+        return self.backend.render(prompt_embeds, negative_prompt_embeds, seeds, steps, guidance_scale=7.5)
+
+    def _open_latent_store(self):
+        """
+        Opens the latent store of the current folder, creating it for the current prompt list if needed.
+        In a sharded run the store is created by the main process, before the workers start.
+        """
+        if not self.store_latents:
+            return None
+        if not self.prompt_list:
+            return LatentStore(self.folder_name)
+        return LatentStore.create(self.folder_name,
+                                  [folder_name_from_prompt(prompt) for prompt in unique_prompts(self.prompt_list)],
+                                  IMAGES_PER_PROMPT, self.backend.latent_shape, self.backend.weights)
 
     def _mkdir_if_not_exists(self, param):
         if not os.path.exists(param):
             os.mkdir(param)
 
-    def _initialize_generator(self):
-        gen = torch.Generator(device='cuda')
-        seed = 26111998
-        return gen.manual_seed(seed)
+    def close(self) -> None:
+        """
+        Waits for the pending images and closes the manifest
+        """
+        self.writer.flush()
+        self.manifest.close()
 
     def set_prompt_list(self, prompt_list):
         self.prompt_list = prompt_list
 
     def set_folder_name(self, folder_name):
+        self.close()
         self.folder_name = folder_name
         self._mkdir_if_not_exists(folder_name)
+        self.manifest = GenerationManifest(folder_name)
+        self.latent_store = self._open_latent_store()
@@ -0,0 +1,96 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+IMAGE_EXTENSIONS = (".png", ".webp")
+
+
+def save_image(image, path: str, image_format: str, options: dict) -> str:
+    """
+    Encodes and writes a single image, runs inside the writer's workers.
+    The image is written to a temporary file and renamed into place, so path either holds a complete image or nothing.
+    """
+    image.save(f"{path}.tmp", format=image_format, **options)
+    os.replace(f"{path}.tmp", path)
+    return path
+
+
+class ImageWriter:
+    """
+    Background writer for the generated images.
+    Images are encoded by a pool of threads (or processes, when use_processes is True) so that PNG/WebP
+    compression never blocks the denoising loop. At most max_pending images are queued at any time:
+    submit() blocks when the queue is full, which keeps memory bounded when the disk is slower than the GPU.
+    Supported formats are "png" (with a zlib compress_level from 0 to 9) and "webp" (always lossless).
+    """
+
+    def __init__(self, image_format: str = "png", compress_level: int = 1, webp_method: int = 4, workers: int = 4,
+                 max_pending: int = 64, use_processes: bool = False) -> None:
+        if image_format == "png":
+            self.pil_format, self.options = "PNG", {"compress_level": compress_level}
+        elif image_format == "webp":
+            self.pil_format, self.options = "WEBP", {"lossless": True, "quality": 100, "method": webp_method}
+        else:
+            raise ValueError(f"Unsupported image format: {image_format}. Please use 'png' or 'webp'.")
+        self.extension = f".{image_format}"
+        pool = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        self.executor = pool(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.in_flight = 0
+        self.errors = []
+        self.idle = threading.Condition()
+
+    def submit(self, image, path: str, on_saved=None) -> None:
+        """
+        Queues image to be written to path + the extension of the chosen format.
+        on_saved(file_path) is called once the image is completely on disk.
+        Blocks while max_pending images are already waiting to be written.
+        """
+        self.slots.acquire()
+        with self.idle:
+            self.in_flight += 1
+        future = self.executor.submit(save_image, image, f"{path}{self.extension}", self.pil_format, self.options)
+        future.add_done_callback(lambda f: self._done(f, on_saved))
+
+    def _done(self, future, on_saved) -> None:
+        try:
+            file_path = future.result()
+            if on_saved is not None:
+                on_saved(file_path)
+        except Exception as e:
+            with self.idle:
+                self.errors.append(e)
+        finally:
+            self.slots.release()
+            with self.idle:
+                self.in_flight -= 1
+                self.idle.notify_all()
+
+    def queue_depth(self) -> int:
+        return self.in_flight
+
+    def flush(self) -> None:
+        """
+        Waits until every queued image is on disk (and its on_saved callback has run),
+        raising the first error of the workers (if any)
+        """
+        with self.idle:
+            self.idle.wait_for(lambda: self.in_flight == 0)
+            errors, self.errors = self.errors, []
+        if errors:
+            raise errors[0]
+
+    def close(self) -> None:
+        """
+        Flushes the queue and stops the workers
+        """
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
@@ -1,67 +1,283 @@
+import hashlib
 import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 from PIL import Image
-from lavis.models import load_model_and_preprocess
-from sentence_transformers import util, SentenceTransformer
+from sentence_transformers import util
 from tqdm import tqdm
+from transformers import LogitsProcessor, LogitsProcessorList
+
+from image_writer import IMAGE_EXTENSIONS
+from model_registry import caption_model, preload
+from progress_index import ProgressIndex
+from sentence_embedding_cache import SENTENCE_MODEL, SentenceEmbeddingCache
+from telemetry import ModelCall, Stage
+
+SEED = 26111998
+NUM_CAPTIONS = 5
+CAPTION_MODEL = "blip_caption"
+CAPTION_MODEL_TYPE = "large_coco"
+
+
+def caption_seed(folder_name: str, image_number: int, caption_number: int, base_seed: int = SEED) -> int:
+    """
+    Derives the sampling seed of a single caption from its concept, image and caption number,
+    so a caption never depends on the other images it is batched with
+    """
+    digest = hashlib.sha256(f"{base_seed}:{folder_name}:{image_number}:{caption_number}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") & 0x7FFFFFFFFFFFFFFF
+
+
+class SeededNucleusSampling(LogitsProcessor):
+    """
+    Nucleus (top-p) sampling in which every row of the batch draws its randomness from its own generator.
+    Like generate(do_sample=True, top_p=0.9) in BlipCaption.generate, the logits are first restricted to the top_k
+    most likely tokens (transformers' default top-k warper, 50 tokens), then to the top_p nucleus.
+    The filtered logits are perturbed with Gumbel noise, so that the greedy argmax taken by generate()
+    is a sample of the filtered distribution: with one seed per row the sampled captions are the same
+    whatever the batch size or the batch composition.
+    It must run after the other logits processors (repetition penalty, min length), which generate() guarantees
+    for the processors passed with logits_processor.
+    """
+
+    def __init__(self, seeds: list, top_p: float = 0.9, top_k: int = 50) -> None:
+        self.generators = [torch.Generator().manual_seed(seed) for seed in seeds]
+        self.top_p = top_p
+        self.top_k = top_k
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        # Same filtering as transformers' TopKLogitsWarper, then TopPLogitsWarper
+        top_k = min(self.top_k, scores.shape[-1])
+        scores = scores.masked_fill(scores < torch.topk(scores, top_k)[0][..., -1, None], -float("inf"))
+        sorted_logits, sorted_indices = torch.sort(scores, descending=False)
+        cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+        sorted_indices_to_remove = cumulative_probs <= (1 - self.top_p)
+        sorted_indices_to_remove[..., -1:] = False
+        indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
+        scores = scores.masked_fill(indices_to_remove, -float("inf"))
+        uniform = torch.stack([torch.rand(scores.shape[-1], generator=generator) for generator in self.generators])
+        gumbel = -torch.log(-torch.log(uniform.clamp(min=1e-20)))
+        return scores + gumbel.to(scores.device, scores.dtype)
 
 
 class ImageInterrogator:
-    def __init__(self, images_path: str) -> None:
+    def __init__(self, images_path: str, max_in_flight: int = 64, decode_workers: int = 4,
+                 batch_size: int = 32) -> None:
         self.images_path = images_path
-        print("Loading images...")
-        self.images = self.load_images()
+        # Images of different folders are captioned together, batch_size images per BLIP call
+        self.batch_size = batch_size
+        # Images are decoded lazily, at most max_in_flight of them being held in memory while waiting for BLIP
+        self.max_in_flight = max_in_flight
+        self.decode_workers = decode_workers
         self.interrogations = {}
+        # For each folder: the NUM_CAPTIONS candidate captions of each image and their similarity with the concept name
+        self.candidate_captions = {}
+        self.caption_scores = {}
+        # Set by interrogate: the callback of the completed folders and whether they get a interrogations.txt
+        self.on_interrogated = None
+        self.save_files = True
+        # Telemetry of the running interrogation, and the time each incomplete folder was loaded at
+        self.stage = None
+        self.loaded_at = {}
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.evaluation_model = SentenceTransformer('all-MiniLM-L6-v2')
-        print("Loaded images - Ready to interrogate")
-
-    def load_images(self) -> dict:
-        """
-        Loads images from self.images_path
-        In self.images_path there are multiple folders, each containing images of a certain concept
-        Load them in the images dict, with the key being the folder name and the value being a
-        list of images in that folder
-        """
-        return {
-            folder: [
-                Image.open(os.path.join(self.images_path, folder, image)).convert("RGB")
-                for image in os.listdir(os.path.join(self.images_path, folder))
-                if image.endswith(".png")
-            ]
-            for folder in tqdm(os.listdir(self.images_path))
-        }
-
-    def interrogate(self) -> None:
-        """
-        For each folder in self.images, interrogate the images in that folder
-        And save in that folder a txt file with the interrogations
-        """
-        model, vis_processors, _ = load_model_and_preprocess(name="blip_caption", model_type="large_coco",
-                                                             is_eval=True, device=self.device)
-        pbar = tqdm(self.images.items())
-        for folder, images in pbar:
-            # Interrogate folder only if it has not been interrogated yet (so there is not a interrogations.txt file)
-            if not os.path.exists(os.path.join(self.images_path, folder, "interrogations.txt")):
-                pbar.set_description(f"Interrogating images from {folder}")
-                self.interrogations[folder] = self.interrogate_folder(images, vis_processors, model, folder)
+        # Models are loaded when there is something to interrogate: MiniLM on the first caption missing from the cache
+        self.embeddings = SentenceEmbeddingCache(None, SENTENCE_MODEL)
+        self.progress = ProgressIndex()
+
+    def pending_folders(self, is_done=None) -> list:
+        """
+        Returns the concept folders of self.images_path that have not been interrogated yet, without opening any image.
+        By default a folder is done when it has a interrogations.txt file, is_done(folder) can tell otherwise.
+        """
+        if is_done is None:
+            def is_done(folder):
+                return os.path.exists(os.path.join(self.images_path, folder, "interrogations.txt"))
+        return [folder for folder in sorted(os.listdir(self.images_path))
+                if os.path.isdir(os.path.join(self.images_path, folder)) and not is_done(folder)]
+
+    def load_images(self, folders: list):
+        """
+        Lazily loads the images of folders from self.images_path, yielding (folder, list of images) pairs in order.
+        Images are decoded by a pool of decode_workers threads while the previous folders are being interrogated,
+        and at most max_in_flight decoded images are waiting to be consumed at any time.
+        """
+        with ThreadPoolExecutor(max_workers=self.decode_workers) as pool:
+            queued = deque()
+            in_flight = 0
+            for folder in folders:
+                paths = [os.path.join(self.images_path, folder, image)
+                         for image in sorted(os.listdir(os.path.join(self.images_path, folder)))
+                         if image.endswith(IMAGE_EXTENSIONS)]
+                # Make room for this folder before decoding it
+                while queued and in_flight + len(paths) > self.max_in_flight:
+                    queued_folder, futures = queued.popleft()
+                    in_flight -= len(futures)
+                    yield queued_folder, self._decoded(queued_folder, futures)
+                queued.append((folder, [pool.submit(self._open_image, path) for path in paths]))
+                in_flight += len(paths)
+            while queued:
+                queued_folder, futures = queued.popleft()
+                yield queued_folder, self._decoded(queued_folder, futures)
+
+    def _decoded(self, folder: str, futures: list) -> list:
+        """
+        Returns the decoded images of folder, recording the folder as failed if one of them cannot be decoded
+        """
+        try:
+            return [future.result() for future in futures]
+        except Exception as error:
+            self.progress.failed("interrogate", self.images_path, [folder], error)
+            raise
+
+    @staticmethod
+    def _open_image(path: str) -> Image.Image:
+        return Image.open(path).convert("RGB")
+
+    def interrogate(self, on_interrogated=None, save: bool = True, is_done=None) -> None:
+        """
+        For each folder in self.images_path that has not been interrogated yet, interrogate the images in that folder
+        And save in that folder a txt file with the interrogations.
+        Images are captioned in batches of self.batch_size that span folder boundaries: a folder is saved
+        as soon as the captions of all its images are back.
+        on_interrogated(folder, captions, embeddings) is then called with the best caption of each image and their
+        sentence embeddings; save=False skips the txt file (see pending_folders for is_done).
+        BLIP is only loaded when some folder is pending, in the background while the first images are decoded.
+        """
+        folders = self.pending_folders(is_done)
+        if not folders:
+            print(f"Nothing to interrogate in {self.images_path}")
+            return
+        preload(caption_model, CAPTION_MODEL, CAPTION_MODEL_TYPE, self.device)
+        pbar = tqdm(total=len(folders))
+        # (folder, image number, image) triples waiting for a batch, and captions of the incomplete folders
+        queued = []
+        captions = {}
+        self.on_interrogated, self.save_files = on_interrogated, save
+        with Stage("interrogate", folder=self.images_path, batch_size=self.batch_size) as self.stage:
+            for folder, images in self.load_images(folders):
+                captions[folder] = [None] * len(images)
+                self.loaded_at[folder] = time.perf_counter()
+                queued.extend((folder, number, image) for number, image in enumerate(images))
+                while len(queued) >= self.batch_size:
+                    self.stage.queue_depth(len(queued))
+                    self._caption_queued(queued[:self.batch_size], captions, pbar)
+                    queued = queued[self.batch_size:]
+                # Folders without images are complete straight away
+                self._save_completed(captions, pbar)
+            if queued:
+                self._caption_queued(queued, captions, pbar)
+        pbar.close()
+
+    def _caption_queued(self, queued: list, captions: dict, pbar) -> None:
+        """
+        Captions and ranks a batch of (folder, image number, image) triples, routes the ranked captions back
+        to their folders and saves the folders that are complete
+        """
+        try:
+            model, vis_processors, _ = caption_model(CAPTION_MODEL, CAPTION_MODEL_TYPE, self.device)
+            batch_captions = self.caption_images([image for _, _, image in queued],
+                                                 [(folder, number) for folder, number, _ in queued], vis_processors,
+                                                 model)
+            batch_scores, batch_embeddings = self._rank(batch_captions, [folder for folder, _, _ in queued])
+        except Exception as error:
+            self.progress.failed("interrogate", self.images_path, sorted({folder for folder, _, _ in queued}), error)
+            raise
+        for (folder, number, _), image_captions, scores, embeddings in zip(
+                queued, batch_captions, batch_scores.tolist(), batch_embeddings.view(len(queued), NUM_CAPTIONS, -1)):
+            captions[folder][number] = (image_captions, scores, embeddings)
+        self._save_completed(captions, pbar)
+
+    def _save_completed(self, captions: dict, pbar) -> None:
+        for folder in [folder for folder, folder_captions in captions.items() if None not in folder_captions]:
+            pbar.set_description(f"Interrogated images from {folder}")
+            ranked = captions.pop(folder)
+            best = [scores.index(max(scores)) for _, scores, _ in ranked]
+            self.candidate_captions[folder] = [image_captions for image_captions, _, _ in ranked]
+            self.caption_scores[folder] = [scores for _, scores, _ in ranked]
+            self.interrogations[folder] = [image_captions[i] for (image_captions, _, _), i in zip(ranked, best)]
+            if self.save_files:
                 self.save_interrogations(folder)
+            self.progress.done("interrogate", self.images_path, [folder])
+            # Latency of a concept: from its images being loaded to its captions being picked
+            self.stage.item(latency=time.perf_counter() - self.loaded_at.pop(folder))
+            if self.on_interrogated is not None:
+                embeddings = torch.stack([embeddings[i] for (_, _, embeddings), i in zip(ranked, best)]) if ranked \
+                    else torch.empty(0)
+                self.on_interrogated(folder, self.interrogations[folder], embeddings)
+            pbar.update(1)
+
+    @torch.no_grad()
+    def caption_images(self, images: list, image_ids: list, vis_processors, model) -> list:
+        """
+        Generates NUM_CAPTIONS captions for each image with a single BLIP call,
+        following BlipCaption.generate with nucleus sampling (see SeededNucleusSampling).
+        image_ids holds the (folder, image number) of each image and seeds its sampling.
+        Returns a list with the list of captions of each image.
+        """
+        seeds = [caption_seed(folder, number, k) for folder, number in image_ids for k in range(NUM_CAPTIONS)]
+        with ModelCall(f"{CAPTION_MODEL}:{CAPTION_MODEL_TYPE}", len(images)):
+            image_batch = torch.stack([vis_processors["eval"](image) for image in images]).to(self.device)
+            image_embeds = model.forward_encoder({"image": image_batch}).repeat_interleave(NUM_CAPTIONS, 0)
+            image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long, device=self.device)
+            prompt = model.tokenizer([model.prompt] * image_embeds.size(0), return_tensors="pt").to(self.device)
+            prompt.input_ids[:, 0] = model.tokenizer.bos_token_id
+            outputs = model.text_decoder.generate(input_ids=prompt.input_ids[:, :-1],
+                                                  max_length=30,
+                                                  min_length=10,
+                                                  do_sample=False,
+                                                  num_beams=1,
+                                                  eos_token_id=model.tokenizer.sep_token_id,
+                                                  pad_token_id=model.tokenizer.pad_token_id,
+                                                  repetition_penalty=1.1,
+                                                  logits_processor=LogitsProcessorList([SeededNucleusSampling(seeds)]),
+                                                  encoder_hidden_states=image_embeds,
+                                                  encoder_attention_mask=image_atts)
+        captions = [output[len(model.prompt):] for output in
+                    model.tokenizer.batch_decode(outputs, skip_special_tokens=True)]
+        return [captions[i:i + NUM_CAPTIONS] for i in range(0, len(captions), NUM_CAPTIONS)]
 
     def interrogate_folder(self, images: list, vis_processors, model, folder_name: str) -> list:
         """
         Interrogates a list of images
         """
-        name = folder_name.replace('_', ' ').replace('-', ',')
-        name_embedding = self.evaluation_model.encode(name)
-        interrogations = []
-        for raw_image in images:
-            image = vis_processors["eval"](raw_image).unsqueeze(0).to(self.device)
-            captions = model.generate({"image": image}, use_nucleus_sampling=True, num_captions=5)
-            best_caption = max(captions, key=lambda x: util.pytorch_cos_sim(self.evaluation_model.encode(x),
-                                                                            name_embedding).item())
-            interrogations.append(best_caption)
-        return interrogations
+        if not images:
+            return []
+        captions = self.caption_images(images, [(folder_name, number) for number in range(len(images))],
+                                       vis_processors, model)
+        return self.select_best_captions(captions, folder_name)
+
+    def select_best_captions(self, captions: list, folder_name: str) -> list:
+        """
+        Given the list of captions of each image of a folder, returns for each image
+        the caption that is closest to the concept name
+        """
+        scores = self.rank_captions(captions, [folder_name] * len(captions))
+        return [image_captions[best] for image_captions, best in zip(captions, scores.argmax(dim=1).tolist())]
+
+    def rank_captions(self, captions: list, folder_names: list) -> torch.Tensor:
+        """
+        Given the list of captions of each image and the folder of each image, returns the (images, captions)
+        matrix of cosine similarities between every caption and the name of its image's concept.
+        All the captions are encoded in a single call, and so are the distinct concept names,
+        only the ones missing from the embedding cache reaching the model.
+        """
+        return self._rank(captions, folder_names)[0]
+
+    def _rank(self, captions: list, folder_names: list) -> tuple:
+        """
+        rank_captions, also returning the (images * captions, dim) embeddings of the captions
+        """
+        name_row = {name: row for row, name in enumerate(dict.fromkeys(folder_names))}
+        names = list(name_row)
+        caption_embeddings = self.embeddings.encode([caption for image_captions in captions
+                                                     for caption in image_captions])
+        name_embeddings = self.embeddings.encode([name.replace('_', ' ').replace('-', ',') for name in names])
+        similarities = util.cos_sim(caption_embeddings, name_embeddings).view(len(captions), -1, len(names))
+        name_index = torch.tensor([name_row[folder] for folder in folder_names], device=similarities.device)
+        return similarities[torch.arange(len(captions), device=similarities.device), :, name_index], caption_embeddings
 
     def save_interrogations(self, folder: str) -> None:
         """
@@ -76,3 +292,16 @@ class ImageInterrogator:
         Returns self.interrogations
         """
         return self.interrogations
+
+    def get_candidate_captions(self) -> dict:
+        """
+        Returns self.candidate_captions: for each folder, the candidate captions of each image
+        """
+        return self.candidate_captions
+
+    def get_caption_scores(self) -> dict:
+        """
+        Returns self.caption_scores: for each folder, the (images x captions) matrix of cosine similarities
+        between the candidate captions and the concept name
+        """
+        return self.caption_scores
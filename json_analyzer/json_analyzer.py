@@ -12,6 +12,9 @@ import xlsxwriter
 from nltk import agreement
 from sklearn.metrics import cohen_kappa_score, classification_report
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from results_store import ResultsStore  # noqa: E402
+
 
 def reject_outliers(data, m=2.):
     d = np.abs(data - np.median(data))
@@ -362,30 +365,16 @@ def special_cases(synset_name: str):
 
 
 def k_humans_vs_stable_diffusion(data: list[dict], m: bool) -> None:
-    def get_cos_scores(path_folder_inside, synset_name, image_dict, treshold, mean=False):
-        # Get the files inside
-        files = os.listdir(path_folder_inside)
-        for file in files:
-            if file == "cosine_scores.txt":
-                if not mean:
-                    path_file = os.path.join(path_folder_inside, file)
-                    with open(path_file, "r") as f:
-                        lines = f.readlines()
-                    max_score = max([float(line.replace("\n", "")) for line in lines[:5]])
-                    if max_score > treshold:
-                        image_dict[synset_name] = "basic"
-                    else:
-                        image_dict[synset_name] = "advanced"
-                else:
-                    path_file = os.path.join(path_folder_inside, file)
-                    with open(path_file, "r") as f:
-                        lines = f.readlines()
-                    scores = [float(line.replace("\n", "")) for line in lines[:5]]
-                    if sum(scores) / len(scores) > treshold:
-                        image_dict[synset_name] = "basic"
-                    else:
-                        image_dict[synset_name] = "advanced"
-
+    def get_cos_scores(scores, synset_name, image_dict, treshold, mean=False):
+        # Only the scores of the first 5 images are considered
+        if not mean:
+            score = max(scores[:5])
+        else:
+            score = sum(scores[:5]) / len(scores[:5])
+        if score > treshold:
+            image_dict[synset_name] = "basic"
+        else:
+            image_dict[synset_name] = "advanced"
         return image_dict
 
     path_stable_diffusion_folder = "/media/evilscript/DATAX/SD1.5/"
@@ -396,36 +385,27 @@ def k_humans_vs_stable_diffusion(data: list[dict], m: bool) -> None:
         synset, answer = line.split(" --> ")
         super_annotator_dict[synset] = answer.replace("\n", "")
 
-    # Open the folder in path_stable_diffusion_folder and get the folders inside
-    image_dict = {}
-    folders = os.listdir(path_stable_diffusion_folder)  # output_middle and output_advanced
+    # The results of output_middle and output_advanced, by concept folder
+    concept_scores = ResultsStore(os.path.join(path_stable_diffusion_folder, "results.npz")).concept_scores()
+    # Match every concept folder with its synset in the super annotator
+    synset_scores = {}
+    for folder_inside, scores in concept_scores.items():
+        synset_name = folder_inside.replace("_", " ").replace("-", ", ")
+        synset_name = special_cases(synset_name)
+        for key in super_annotator_dict.keys():
+            part_to_consider = key.split(" | ")[0].split("):")[1]
+            if synset_name == part_to_consider:
+                synset_name = key
+                break
+        if synset_name.startswith("Synset"):
+            synset_scores[synset_name] = scores.tolist()
 
-    path_folder1 = os.path.join(path_stable_diffusion_folder, folders[0])
-    path_folder2 = os.path.join(path_stable_diffusion_folder, folders[1])
+    image_dict = {}
     best_k = 0
     best_threshold = 0
     for tr in np.arange(0, 0.7, 0.0001):
-        if os.path.isdir(path_folder1) and os.path.isdir(path_folder2):
-            # Get the folders inside
-            folders_inside = os.listdir(path_folder1) + os.listdir(path_folder2)
-            for folder_inside in folders_inside:
-                synset_name = folder_inside.replace("_", " ").replace("-", ", ")
-                synset_name = special_cases(synset_name)
-                for key in super_annotator_dict.keys():
-                    part_to_consider = key.split(" | ")[0].split("):")[1]
-                    if synset_name == part_to_consider:
-                        synset_name = key
-                        break
-
-                if synset_name.startswith("Synset"):
-                    path_folder_inside1 = os.path.join(path_folder1, folder_inside)
-                    path_folder_inside2 = os.path.join(path_folder2, folder_inside)
-                    if os.path.isdir(path_folder_inside1):
-                        image_dict = get_cos_scores(path_folder_inside1, synset_name, image_dict, treshold=tr, mean=m)
-                    elif os.path.isdir(path_folder_inside2):
-                        image_dict = get_cos_scores(path_folder_inside2, synset_name, image_dict, treshold=tr, mean=m)
-                    else:
-                        print(f"{path_folder_inside1} or {path_folder_inside2} is not a folder")
+        for synset_name, scores in synset_scores.items():
+            image_dict = get_cos_scores(scores, synset_name, image_dict, treshold=tr, mean=m)
 
         # Evaluate Cohen's kappa for the super annotator vs stable diffusion
         super_annotator_answers = []
@@ -0,0 +1,136 @@
+import json
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+
+class LatentStore:
+    """
+    Memory-mapped store of the final (pre-VAE) latents of one output folder, so images can be decoded again
+    at another resolution or in another codec without re-running the 30 denoising steps.
+    The latents of image j of the i-th concept folder of the store (counted from 0) live in row
+    i * images_per_prompt + j of output_middle.latents.npy (float16); output_middle.latents.filled.npy flags the rows
+    that hold a latent and output_middle.latents.json keeps the shape, the weights and the concept folders in row order.
+    Rows belong to concept folders, not to positions in the prompt list: editing the list leaves the stored latents
+    in place, and the concepts it adds get rows appended at the end.
+    Rows are written in place, so the workers of a sharded run can share the same store.
+    """
+
+    def __init__(self, folder_name: str) -> None:
+        base = os.path.normpath(folder_name)
+        self.folder_name = folder_name
+        self.meta_path = f"{base}.latents.json"
+        with open(self.meta_path, "r") as f:
+            self.meta = json.load(f)
+        self.images_per_prompt = self.meta["images_per_prompt"]
+        if "concepts" not in self.meta:
+            # Stores created before the rows were keyed by concept list the prompts instead
+            from image_generator import folder_name_from_prompt
+            self.meta["concepts"] = [folder_name_from_prompt(prompt) for prompt in self.meta.pop("prompts")]
+        self.concepts = self.meta["concepts"]
+        self.concept_rows = {}
+        for i, concept in enumerate(self.concepts):
+            self.concept_rows.setdefault(concept, i)
+        self.latents = np.load(f"{base}.latents.npy", mmap_mode="r+")
+        self.filled = np.load(f"{base}.latents.filled.npy", mmap_mode="r+")
+
+    @staticmethod
+    def exists(folder_name: str) -> bool:
+        return os.path.exists(f"{os.path.normpath(folder_name)}.latents.json")
+
+    @classmethod
+    def create(cls, folder_name: str, concepts: list, images_per_prompt: int, latent_shape: tuple, weights: str):
+        """
+        Creates an empty store with one row per image of the concept folders concepts, or opens the existing one,
+        appending rows for the concepts it does not have yet. The existing store must hold latents of the same shape
+        and weights: the latents of another model cannot be decoded by this one.
+        Not safe to call while another process writes into the store (the sharded runs create it before their
+        workers start).
+        """
+        if not cls.exists(folder_name):
+            cls._write(folder_name, [], {"concepts": list(dict.fromkeys(concepts)),
+                                         "images_per_prompt": images_per_prompt, "shape": list(latent_shape),
+                                         "weights": weights})
+        store = cls(folder_name)
+        if store.meta["shape"] != list(latent_shape) or store.meta["weights"] != weights:
+            raise ValueError(f"The latent store of {folder_name} holds {tuple(store.meta['shape'])} latents of "
+                             f"{store.meta['weights']}, not {tuple(latent_shape)} latents of {weights}: remove "
+                             f"{os.path.normpath(folder_name)}.latents.* to store the latents of this model")
+        new = [concept for concept in dict.fromkeys(concepts) if concept not in store.concept_rows]
+        if new:
+            cls._write(folder_name, [store.latents, store.filled], {**store.meta, "concepts": store.concepts + new})
+            store = cls(folder_name)
+        return store
+
+    @staticmethod
+    def _write(folder_name: str, arrays: list, meta: dict) -> None:
+        """
+        Writes the arrays of a store with the rows of the concepts of meta, copying the rows of arrays
+        (the latents and filled flags of the current store, if any) at the beginning, then writes meta.
+        The metadata is written last, so a store only lists concepts once their rows exist.
+        """
+        base = os.path.normpath(folder_name)
+        rows = len(meta["concepts"]) * meta["images_per_prompt"]
+        files = ((f"{base}.latents.npy", np.float16, (rows, *meta["shape"])),
+                 (f"{base}.latents.filled.npy", np.uint8, (rows,)))
+        for i, (path, dtype, shape) in enumerate(files):
+            array = np.lib.format.open_memmap(f"{path}.tmp", mode="w+", dtype=dtype, shape=shape)
+            if arrays:
+                for start in range(0, min(len(arrays[i]), rows), 4096):
+                    end = min(start + 4096, len(arrays[i]), rows)
+                    array[start:end] = arrays[i][start:end]
+            array.flush()
+            del array
+            os.replace(f"{path}.tmp", path)
+        with open(f"{base}.latents.json.tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(f"{base}.latents.json.tmp", f"{base}.latents.json")
+
+    def row(self, concept: str, image_number: int) -> int:
+        return self.concept_rows[concept] * self.images_per_prompt + image_number
+
+    def write(self, rows: list, latents) -> None:
+        """
+        Stores latents (a (len(rows), *shape) tensor or array) and flags their rows as filled
+        """
+        if hasattr(latents, "detach"):
+            latents = latents.detach().float().cpu().numpy()
+        self.latents[rows] = latents.astype(np.float16)
+        self.latents.flush()
+        self.filled[rows] = 1
+        self.filled.flush()
+
+    def filled_rows(self) -> list:
+        return np.flatnonzero(self.filled).tolist()
+
+    def read(self, rows: list) -> np.ndarray:
+        return np.asarray(self.latents[rows])
+
+    def image_of_row(self, row: int) -> tuple:
+        """
+        Returns the (concept folder, image number) of row
+        """
+        concept_number, image_number = divmod(row, self.images_per_prompt)
+        return self.concepts[concept_number], image_number
+
+
+def decode_store(folder_name: str, backend, writer, output_folder: str, batch_size: int = 16) -> None:
+    """
+    Rebuilds every image stored in the latent store of folder_name, decoding batch_size latents at a time
+    with the backend's VAE and writing them to output_folder with the usual concept/{j} layout
+    """
+    store = LatentStore(folder_name)
+    rows = store.filled_rows()
+    pbar = tqdm(total=len(rows), desc=f"Decoding {folder_name}")
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        images = backend.decode(store.read(batch))
+        for row, image in zip(batch, images):
+            concept, j = store.image_of_row(row)
+            concept_folder = os.path.join(output_folder, concept)
+            os.makedirs(concept_folder, exist_ok=True)
+            writer.submit(image, os.path.join(concept_folder, str(j)))
+        pbar.update(len(batch))
+    pbar.close()
+    writer.flush()
@@ -0,0 +1,205 @@
+import copy
+import hashlib
+import os
+import time
+
+import torch
+
+from model_registry import causal_lm
+from sqlite_database import SQLiteDatabase
+from telemetry import ModelCall
+
+# Next to the other caches of the repository, whatever the directory the scripts run from
+VERDICTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "llm_verdicts.sqlite")
+# "gpu", or "cpu-int8" on the nodes without a GPU (see model_registry.causal_lm)
+JUDGE_BACKEND = os.environ.get("PIPELINE_JUDGE_BACKEND", "gpu")
+# Threads of the CPU backend, PyTorch's default (the physical cores) when unset
+JUDGE_THREADS = int(os.environ["PIPELINE_JUDGE_THREADS"]) if "PIPELINE_JUDGE_THREADS" in os.environ else None
+
+
+def template_id(template: str) -> str:
+    return hashlib.sha256(template.encode("utf-8")).hexdigest()[:16]
+
+
+class VerdictCache:
+    """
+    Persistent cache of the answers of the yes/no judges, keyed by (checkpoint, hash of the prompt template, word).
+    Verdicts are written batch by batch, so an interrupted run resumes where it stopped, and a rerun with the same
+    model and prompt never runs the model. Changing a single character of the template starts a new set of verdicts.
+    """
+
+    def __init__(self, path: str = VERDICTS_PATH) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = SQLiteDatabase(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS verdicts (checkpoint TEXT, template TEXT, word TEXT,"
+                        " yes_probability REAL, created REAL, PRIMARY KEY (checkpoint, template, word))")
+
+    def get(self, checkpoint: str, template: str, words: list = None) -> dict:
+        """
+        Returns {word: probability of "yes"} for the words of words that have a verdict (every word when None)
+        """
+        with self.db.lock:
+            if words is None:
+                return dict(self.db.execute("SELECT word, yes_probability FROM verdicts WHERE checkpoint = ? AND"
+                                            " template = ?", (checkpoint, template_id(template))))
+            return dict(self.db.select_in("SELECT word, yes_probability FROM verdicts WHERE checkpoint = ? AND"
+                                          " template = ? AND word IN ({})", (checkpoint, template_id(template)),
+                                          words))
+
+    def put(self, checkpoint: str, template: str, verdicts: dict) -> None:
+        """
+        Stores {word: probability of "yes"}
+        """
+        now = time.time()
+        with self.db.transaction():
+            self.db.executemany("INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?)",
+                                [(checkpoint, template_id(template), word, probability, now)
+                                 for word, probability in verdicts.items()])
+
+    def close(self) -> None:
+        self.db.close()
+
+
+class YesNoJudge:
+    """
+    Answers a yes/no question about many words with a causal language model, e.g. OPT in the TransFilters.
+    Instead of generating an answer word by word, the prompts of a batch are left-padded and go through
+    a single forward pass: the answer is read from the next-token logits of " yes" and " no" at the last position,
+    which gives the probability of "yes" (between the two answers) and not only the greedy answer.
+    Prompts are batched by length, so little of the forward pass is spent on padding.
+    Verdicts are kept in a VerdictCache (unless cache is False): only the words without a verdict reach the model,
+    which is not even loaded when every word has one.
+    With reuse_prefix, the few-shot prefix that every prompt starts with goes through the model once: its past
+    key/values are expanded over every batch, whose (right-padded) prompts are then only the few tokens of each word.
+    The "cpu-int8" backend runs the model on the CPU with int8 linear layers: its verdicts are cached apart from the
+    ones of the checkpoint's own precision, under model_id.
+    """
+
+    def __init__(self, checkpoint: str, template: str, batch_size: int = 32, cache=True,
+                 reuse_prefix: bool = True, backend: str = JUDGE_BACKEND, threads: int = JUDGE_THREADS) -> None:
+        self.checkpoint = checkpoint
+        self.backend = backend
+        self.threads = threads
+        self.model_id = checkpoint if backend == "gpu" else f"{checkpoint}:{backend}"
+        # The prompt of a word, with a {word} placeholder
+        self.template = template
+        self.batch_size = batch_size
+        self.answer_ids = None
+        self.cache = VerdictCache() if cache is True else cache or None
+        self.reuse_prefix = reuse_prefix
+        # (suffix template, prefix length, past key/values of the prefix), False when the prefix cannot be reused
+        self.prefix_state = None
+
+    @property
+    def tokenizer(self):
+        tokenizer = causal_lm(self.checkpoint, self.backend, self.threads)[0]
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        return tokenizer
+
+    @property
+    def model(self):
+        # Loaded on the first word to judge, and shared with the other judges of the process
+        return causal_lm(self.checkpoint, self.backend, self.threads)[1]
+
+    def _answer_ids(self) -> list:
+        """
+        Returns the token ids of " yes" and " no" (the answers follow "->" after a space)
+        """
+        if self.answer_ids is None:
+            self.answer_ids = [self.tokenizer.encode(answer, add_special_tokens=False)[0] for answer in (" yes", " no")]
+        return self.answer_ids
+
+    def yes_probabilities(self, words: list) -> list:
+        """
+        Returns, for every word, the probability that the model answers "yes" rather than "no" to its prompt
+        """
+        unique = list(dict.fromkeys(words))
+        verdicts = self.cache.get(self.model_id, self.template, unique) if self.cache is not None else {}
+        missing = sorted((word for word in unique if word not in verdicts),
+                         key=lambda word: len(self.template.format(word=word)))
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            judged = dict(zip(batch, self._judge(batch)))
+            # Written batch by batch, so an interrupted run keeps what it has judged
+            if self.cache is not None:
+                self.cache.put(self.model_id, self.template, judged)
+            verdicts.update(judged)
+        return [verdicts[word] for word in words]
+
+    def _judge(self, words: list) -> list:
+        """
+        Returns the probability of "yes" for each word, with or without the past key/values of the prefix
+        """
+        state = self._prefix() if self.reuse_prefix else False
+        if not state:
+            return self._judge_prompts([self.template.format(word=word) for word in words])
+        return self._judge_suffixes(words, *state)
+
+    @torch.no_grad()
+    def _judge_prompts(self, prompts: list) -> list:
+        tokenizer = self.tokenizer
+        tokenizer.padding_side = "left"
+        inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(self.model.device)
+        with ModelCall(self.model_id, len(prompts)):
+            # With left padding, the last position is the last token of every prompt
+            logits = self.model(**inputs).logits[:, -1, self._answer_ids()]
+        return logits.float().softmax(dim=-1)[:, 0].tolist()
+
+    @torch.no_grad()
+    def _judge_suffixes(self, words: list, suffix_template: str, prefix_length: int, past) -> list:
+        tokenizer = self.tokenizer
+        # Right padding keeps the word tokens right after the prefix, at the positions they have in the whole prompt
+        tokenizer.padding_side = "right"
+        inputs = tokenizer([suffix_template.format(word=word) for word in words], return_tensors="pt", padding=True,
+                           add_special_tokens=False).to(self.model.device)
+        batch = len(words)
+        attention_mask = torch.cat([inputs.attention_mask.new_ones(batch, prefix_length), inputs.attention_mask], dim=1)
+        with ModelCall(self.model_id, batch):
+            logits = self.model(input_ids=inputs.input_ids, attention_mask=attention_mask,
+                                past_key_values=expand_past(past, batch)).logits
+        # Logits of the last token of every word, before its padding
+        last = inputs.attention_mask.sum(dim=1) - 1
+        logits = logits[torch.arange(batch, device=logits.device), last][:, self._answer_ids()]
+        return logits.float().softmax(dim=-1)[:, 0].tolist()
+
+    def split_template(self) -> tuple:
+        """
+        Returns the prefix shared by every prompt and the template of the rest of a prompt. The template is split
+        before the spaces that precede the word, so the word starts a new token as it does in the whole prompt.
+        """
+        prefix, suffix = self.template.split("{word}", 1)
+        shared = prefix.rstrip()
+        return shared, prefix[len(shared):] + "{word}" + suffix
+
+    @torch.no_grad()
+    def _prefix(self):
+        """
+        Returns (suffix template, prefix length, past key/values of the prefix), computed on the first call,
+        or False when the two halves of a prompt do not tokenize as the whole prompt
+        """
+        if self.prefix_state is None:
+            prefix, suffix_template = self.split_template()
+            tokenizer = self.tokenizer
+            prefix_ids = tokenizer(prefix, return_tensors="pt").input_ids
+            sample = suffix_template.format(word="dog")
+            if tokenizer(prefix + sample).input_ids != prefix_ids[0].tolist() + tokenizer(
+                    sample, add_special_tokens=False).input_ids:
+                self.prefix_state = False
+            else:
+                past = self.model(input_ids=prefix_ids.to(self.model.device), use_cache=True).past_key_values
+                self.prefix_state = (suffix_template, prefix_ids.shape[1], past)
+        return self.prefix_state
+
+
+def expand_past(past, batch: int):
+    """
+    Returns a copy of the past key/values of the prefix (a Cache object, or (key, value) pairs for the transformers
+    versions without one) repeated over the batch. A copy is made for every batch, since the model appends
+    the keys and values of the batch to the cache it is given.
+    """
+    if isinstance(past, tuple):
+        return tuple((key.expand(batch, -1, -1, -1), value.expand(batch, -1, -1, -1)) for key, value in past)
+    past = copy.deepcopy(past)
+    past.batch_repeat_interleave(batch)
+    return past
@@ -0,0 +1,190 @@
+import gc
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from telemetry import emit
+
+# Memory budget of the loaded models in MB (host and device memory together), unlimited when unset
+MODEL_BUDGET_MB = float(os.environ["PIPELINE_MODEL_BUDGET_MB"]) if "PIPELINE_MODEL_BUDGET_MB" in os.environ else None
+# Sizes of the models loaded by the previous runs, next to the other caches of the repository
+SIZES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "model_sizes.json")
+
+
+def model_size_mb(model) -> float:
+    """
+    Memory taken by the parameters and buffers of the torch modules of model,
+    which may also be a tuple of a model and its processors (e.g. a tokenizer)
+    """
+    import torch
+    if isinstance(model, (tuple, list)):
+        return sum(model_size_mb(part) for part in model)
+    if hasattr(model, "components"):
+        # A diffusers pipeline
+        return sum(model_size_mb(component) for component in model.components.values())
+    if not isinstance(model, torch.nn.Module):
+        return 0.0
+    tensors = list(model.parameters()) + list(model.buffers())
+    # The weights of the dynamically quantized layers are packed, out of the parameters
+    tensors += [module.weight() for module in model.modules()
+                if isinstance(getattr(module, "_packed_params", None), torch.nn.Module)]
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors) / 2 ** 20
+
+
+class ModelRegistry:
+    """
+    Process-wide registry of the heavy models: every model is loaded once, on the first get() asking for it,
+    and every later get() hands out the same instance.
+    When the loaded models take more than budget_mb, the least recently used ones are dropped from the registry
+    (a stage still holding one keeps it alive until it lets it go, the registry only stops holding it).
+    The size of a model is known once it has been loaded: it is kept in sizes_path, so every later load, in this
+    process or the next ones, makes room beforehand. Only the very first load of a model makes room afterwards.
+    """
+
+    def __init__(self, budget_mb: float = MODEL_BUDGET_MB, sizes_path: str = SIZES_PATH) -> None:
+        self.budget_mb = budget_mb
+        self.models = OrderedDict()
+        self.sizes_path = sizes_path
+        self.sizes = {}
+        if sizes_path is not None and os.path.exists(sizes_path):
+            with open(sizes_path, "r") as f:
+                self.sizes = json.load(f)
+        # Held while loading, so two threads asking for the same model do not load it twice
+        self.lock = threading.RLock()
+
+    def get(self, name: str, loader):
+        """
+        Returns the model called name, calling loader() to load it if it is not loaded yet
+        """
+        with self.lock:
+            if name in self.models:
+                self.models.move_to_end(name)
+                return self.models[name]
+            self._evict(self.sizes.get(name, 0.0))
+            start = time.perf_counter()
+            model = loader()
+            self.sizes[name] = model_size_mb(model)
+            self.models[name] = model
+            self._save_sizes()
+            emit({"type": "load", "model": name, "wall": time.perf_counter() - start, "size_mb": self.sizes[name]})
+            self._evict(0.0, keep=name)
+            return model
+
+    def _save_sizes(self) -> None:
+        if self.sizes_path is None:
+            return
+        os.makedirs(os.path.dirname(self.sizes_path) or ".", exist_ok=True)
+        # One temporary file per process, since the workers of a sharded run load their models at the same time
+        with open(f"{self.sizes_path}.{os.getpid()}.tmp", "w") as f:
+            json.dump(self.sizes, f, indent=1)
+        os.replace(f"{self.sizes_path}.{os.getpid()}.tmp", self.sizes_path)
+
+    def loaded_mb(self) -> float:
+        return sum(self.sizes[name] for name in self.models)
+
+    def _evict(self, needed_mb: float, keep: str = None) -> None:
+        """
+        Drops the least recently used models until needed_mb more fit in the budget
+        """
+        if self.budget_mb is None:
+            return
+        evicted = False
+        for name in list(self.models):
+            if self.loaded_mb() + needed_mb <= self.budget_mb:
+                break
+            if name == keep:
+                continue
+            print(f"Unloading {name} ({self.sizes[name]:.0f} MB) to stay within {self.budget_mb:.0f} MB")
+            del self.models[name]
+            evicted = True
+        if evicted:
+            self._release()
+
+    def evict(self, name: str) -> None:
+        with self.lock:
+            if self.models.pop(name, None) is not None:
+                self._release()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.models.clear()
+            self._release()
+
+    @staticmethod
+    def _release() -> None:
+        gc.collect()
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+registry = ModelRegistry()
+
+
+def preload(model, *args) -> threading.Thread:
+    """
+    Starts loading a model in the background, model being one of the functions below and args its arguments:
+    the stage keeps scanning the disk meanwhile, and its own call to model(*args) waits for the load to end
+    (or loads the model again, raising the error, if the background load failed)
+    """
+    thread = threading.Thread(target=model, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def sentence_model(name: str = None):
+    """
+    The SentenceTransformer used to rank and score the captions
+    """
+    from sentence_embedding_cache import SENTENCE_MODEL
+    name = name or SENTENCE_MODEL
+
+    def load():
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(name)
+
+    return registry.get(f"sentence-transformers:{name}", load)
+
+
+def caption_model(name: str, model_type: str, device) -> tuple:
+    """
+    The (model, visual processors, text processors) of a LAVIS captioning model on device
+    """
+
+    def load():
+        from lavis.models import load_model_and_preprocess
+        return load_model_and_preprocess(name=name, model_type=model_type, is_eval=True, device=device)
+
+    return registry.get(f"lavis:{name}:{model_type}:{device}", load)
+
+
+def diffusion_pipeline(weights: str, device, dtype, loader):
+    """
+    The diffusers pipeline of weights in dtype on device, loader() loading it (see diffusion_backends)
+    """
+    return registry.get(f"diffusers:{weights}:{device}:{dtype}", loader)
+
+
+def causal_lm(checkpoint: str, backend: str = "gpu", threads: int = None) -> tuple:
+    """
+    The (tokenizer, model) of a causal language model of the Hugging Face hub, with backend either
+    "gpu" (the precision of the checkpoint, e.g. fp16 for OPT, on the available devices) or "cpu-int8"
+    (on the CPU in fp32, with dynamically quantized int8 linear layers, running on threads threads when given)
+    """
+    if backend not in ("gpu", "cpu-int8"):
+        raise ValueError(f"Unknown causal LM backend: {backend}. Please use one of gpu, cpu-int8.")
+
+    def load():
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(checkpoint)
+        if backend == "gpu":
+            return tokenizer, AutoModelForCausalLM.from_pretrained(checkpoint, torch_dtype="auto", device_map="auto")
+        import torch
+        if threads:
+            torch.set_num_threads(threads)
+        model = AutoModelForCausalLM.from_pretrained(checkpoint, torch_dtype=torch.float32).eval()
+        return tokenizer, torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    return registry.get(f"causal-lm:{checkpoint}" if backend == "gpu" else f"causal-lm:{checkpoint}:{backend}", load)
@@ -1,3 +1,4 @@
+import argparse
 import sys
 
 
@@ -7,20 +8,56 @@ def flush_dict_to_file(dictionary, file_path):
             f.write(f"{key} -> {value}\n")
 
 
-def generate():
-    from image_generator import ImageGenerator
+def generate(batch_size=4, image_format="png", devices=None, backend="sd", store_latents=False, steps=30):
+    from diffusion_backends import get_backend
+    from image_generator import ImageGenerator, pending_images
     from image_title_creator import ImageTitleCreator
+    from image_writer import ImageWriter
     # First, create the titles for each image
     itc = ImageTitleCreator()
     synset_titles = itc.get_synset_titles()
     hyponym_titles = itc.get_hyponym_titles()
+    if devices:
+        # Sharded mode: one worker process per device, all pulling concepts from the same queue
+        from functools import partial
+        from sharded_generation import build_image_generator, generate_sharded
+        generate_sharded({"output_middle": synset_titles, "output_advanced": hyponym_titles}, devices,
+                         factory=partial(build_image_generator, image_format=image_format, backend=backend,
+                                         store_latents=store_latents),
+                         steps=steps, batch_size=batch_size,
+                         latent_backend=get_backend(backend) if store_latents else None)
+        return
+    # Pre-flight: count the missing images from the manifests, the model is only loaded if there are some,
+    # in the background while the generator reads the manifests
+    if not pending_images("output_middle", synset_titles) + pending_images("output_advanced", hyponym_titles):
+        print("Nothing to generate")
+        return
     # Then, generate the images for the middle concepts (synsets)
-    ig = ImageGenerator(synset_titles, folder_name="output_middle")
-    ig.generate_images(steps=30)
-    # Generate the images for the advanced concepts (hyponyms)
-    ig.set_prompt_list(hyponym_titles)
-    ig.set_folder_name("output_advanced")
-    ig.generate_images(steps=30)
+    with ImageWriter(image_format=image_format) as writer:
+        ig = ImageGenerator(synset_titles, folder_name="output_middle", writer=writer, backend=get_backend(backend),
+                            store_latents=store_latents, preload=True)
+        ig.generate_images(steps=steps, batch_size=batch_size)
+        # Generate the images for the advanced concepts (hyponyms)
+        ig.set_prompt_list(hyponym_titles)
+        ig.set_folder_name("output_advanced")
+        ig.generate_images(steps=steps, batch_size=batch_size)
+        ig.close()
+
+
+def decode(batch_size=16, image_format="png", backend="sd"):
+    from diffusion_backends import get_backend
+    from image_writer import ImageWriter
+    from latent_store import LatentStore, decode_store
+    # Rebuild the images from the stored latents, without denoising again
+    diffusion_backend = get_backend(backend)
+    diffusion_backend.load()
+    with ImageWriter(image_format=image_format) as writer:
+        for folder_name in ("output_middle", "output_advanced"):
+            if not LatentStore.exists(folder_name):
+                print(f"No latents stored for {folder_name}, generate with --store-latents first")
+                continue
+            decode_store(folder_name, diffusion_backend, writer, output_folder=f"{folder_name}_decoded",
+                         batch_size=batch_size)
 
 
 def interrogate():
@@ -36,27 +73,142 @@ def interrogate():
     ii2.interrogate()
 
 
-def evaluate():
-    from evaluation import Evaluation
-    ev = Evaluation("output_middle")
-    ev.print_to_file()
-    ev = Evaluation("output_advanced")
-    ev.print_to_file()
+def evaluate(text_files=False):
+    from evaluation import CorpusEvaluation
+    # Score the captions of both output folders at once, skipping the folders whose captions did not change.
+    # Results go to results.npz, and also to a cosine_scores.txt per concept folder with text_files
+    CorpusEvaluation(["output_middle", "output_advanced"], text_files=text_files).evaluate()
+
+
+def interrogate_evaluate(text_files=False, interrogation_files=True):
+    import queue
+    import threading
+    from functools import partial
+    from evaluation import CorpusEvaluation
+    from interrogate_images import ImageInterrogator
+    sys.path.append('src/blip')
+    sys.path.append('src/clip')
+    sys.path.append('clip-interrogator')
+
+    # Caption and score in a single pass: the best captions of every concept go through a queue to the scorer,
+    # which shares the interrogator's MiniLM and reuses the embeddings of the captions
+    output_folders = ["output_middle", "output_advanced"]
+    interrogator = ImageInterrogator(images_path=output_folders[0])
+    scorer = CorpusEvaluation(output_folders, text_files=text_files, embeddings=interrogator.embeddings)
+    interrogations = queue.Queue(maxsize=256)
+    scoring = threading.Thread(target=scorer.score_stream, args=(interrogations,))
+    scoring.start()
+    try:
+        for output_folder in output_folders:
+            interrogator.images_path = output_folder
+            # Without the interrogations.txt files, a concept is done once it is in the results store
+            interrogator.interrogate(
+                on_interrogated=lambda folder, captions, embeddings, output_folder=output_folder: interrogations.put(
+                    (output_folder, folder, captions, embeddings)),
+                save=interrogation_files,
+                is_done=None if interrogation_files else partial(scorer.is_scored, output_folder))
+    finally:
+        interrogations.put(None)
+        scoring.join()
+    if scorer.stream_error is not None:
+        raise scorer.stream_error
+    if interrogation_files:
+        # Concepts interrogated by an earlier run that stopped before scoring them
+        scorer.evaluate()
+
+
+def run_all(dry_run=False, steps=30, batch_size=4, image_format="png", devices=None, backend="sd"):
+    from functools import partial
+    from pipeline_dag import PipelineGraph
+    # Run every stage, but only for the concepts whose inputs changed since the last run (or that never finished)
+    graph = PipelineGraph(steps=steps, backend=backend)
+    graph.run({"generate": partial(generate, batch_size=batch_size, image_format=image_format, devices=devices,
+                                   backend=backend, steps=steps),
+               "interrogate": interrogate,
+               "evaluate": evaluate},
+              dry_run=dry_run)
+
+
+def profile(path=None, run=None):
+    import telemetry
+    # Summary of the stages and model calls of a run, compared with the previous run
+    telemetry.report(path or telemetry.TELEMETRY_PATH, run)
+
+
+def status(rebuild=False):
+    from image_title_creator import ImageTitleCreator
+    from progress_index import ProgressIndex, status as print_status
+    # Progress of every stage from the progress index, without walking the output folders
+    titles = ImageTitleCreator()
+    prompt_lists = {"output_middle": titles.get_synset_titles(), "output_advanced": titles.get_hyponym_titles()}
+    if rebuild:
+        ProgressIndex().rebuild(prompt_lists)
+    print_status(prompt_lists=prompt_lists)
 
 
 def pipeline():
     # Take arguments from the command line
-    if len(sys.argv) > 1:
-        if sys.argv[1] == "generate":
-            generate()
-        elif sys.argv[1] == "interrogate":
-            interrogate()
-        elif sys.argv[1] == "evaluate":
-            evaluate()
-        else:
-            print("Invalid argument. Please use 'generate' or 'interrogate' or 'evaluate' as argument.")
+    parser = argparse.ArgumentParser(description="Synset-to-image-to-description pipeline")
+    commands = parser.add_subparsers(dest="command")
+    generate_parser = commands.add_parser("generate", help="Generate the images of every concept")
+    generate_parser.add_argument("--batch-size", type=int, default=4, help="Prompts packed in a single pipeline call")
+    generate_parser.add_argument("--format", choices=["png", "webp"], default="png", dest="image_format",
+                                 help="Output codec of the generated images (webp is lossless)")
+    generate_parser.add_argument("--devices", type=lambda value: value.split(","),
+                                 help="Comma separated devices (e.g. cuda:0,cuda:1), one worker process each")
+    generate_parser.add_argument("--backend", choices=["sd", "cpu", "fake"], default="sd",
+                                 help="Stable Diffusion on CUDA (sd), on the CPU (cpu) or synthetic images (fake)")
+    generate_parser.add_argument("--store-latents", action="store_true",
+                                 help="Also keep the final latents, so the images can be decoded again later")
+    decode_parser = commands.add_parser("decode", help="Rebuild the images from the stored latents")
+    decode_parser.add_argument("--batch-size", type=int, default=16, help="Latents decoded in a single VAE call")
+    decode_parser.add_argument("--format", choices=["png", "webp"], default="png", dest="image_format")
+    decode_parser.add_argument("--backend", choices=["sd", "cpu", "fake"], default="sd")
+    commands.add_parser("interrogate", help="Caption the generated images")
+    evaluate_parser = commands.add_parser("evaluate", help="Score the captions against the concept names")
+    evaluate_parser.add_argument("--text-scores", action="store_true",
+                                 help="Also write a cosine_scores.txt in every concept folder")
+    fused_parser = commands.add_parser("interrogate-evaluate",
+                                       help="Caption the generated images and score the captions in a single pass")
+    fused_parser.add_argument("--text-scores", action="store_true",
+                              help="Also write a cosine_scores.txt in every concept folder")
+    fused_parser.add_argument("--no-interrogation-files", action="store_false", dest="interrogation_files",
+                              help="Do not write the interrogations.txt files, the captions are in results.npz")
+    all_parser = commands.add_parser("all", help="Run every stage, redoing only what changed since the last run")
+    all_parser.add_argument("--dry-run", action="store_true", help="Only report what would run")
+    all_parser.add_argument("--steps", type=int, default=30, help="Denoising steps of every image")
+    all_parser.add_argument("--batch-size", type=int, default=4, help="Prompts packed in a single pipeline call")
+    all_parser.add_argument("--format", choices=["png", "webp"], default="png", dest="image_format")
+    all_parser.add_argument("--devices", type=lambda value: value.split(","),
+                            help="Comma separated devices (e.g. cuda:0,cuda:1), one worker process each")
+    all_parser.add_argument("--backend", choices=["sd", "cpu", "fake"], default="sd")
+    profile_parser = commands.add_parser("profile", help="Summarize the throughput of a run from its telemetry")
+    profile_parser.add_argument("--file", dest="path", help="Telemetry file (telemetry.jsonl by default)")
+    profile_parser.add_argument("--run", help="Run id (the last run by default)")
+    status_parser = commands.add_parser("status", help="Show the progress of every stage")
+    status_parser.add_argument("--rebuild", action="store_true",
+                               help="Rebuild the progress index from the output folders first")
+    args = parser.parse_args()
+    if args.command == "generate":
+        generate(batch_size=args.batch_size, image_format=args.image_format, devices=args.devices,
+                 backend=args.backend, store_latents=args.store_latents)
+    elif args.command == "decode":
+        decode(batch_size=args.batch_size, image_format=args.image_format, backend=args.backend)
+    elif args.command == "interrogate":
+        interrogate()
+    elif args.command == "evaluate":
+        evaluate(text_files=args.text_scores)
+    elif args.command == "all":
+        run_all(dry_run=args.dry_run, steps=args.steps, batch_size=args.batch_size, image_format=args.image_format,
+                devices=args.devices, backend=args.backend)
+    elif args.command == "status":
+        status(rebuild=args.rebuild)
+    elif args.command == "profile":
+        profile(path=args.path, run=args.run)
+    elif args.command == "interrogate-evaluate":
+        interrogate_evaluate(text_files=args.text_scores, interrogation_files=args.interrogation_files)
     else:
-        print("Please provide an argument. Use 'generate' or 'interrogate' or 'evaluate' as argument.")
+        parser.print_help()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,209 @@
+import hashlib
+import json
+import os
+
+from generation_manifest import GenerationManifest
+from image_generator import (IMAGES_PER_PROMPT, NEGATIVE_PROMPT, SEED, concept_done, folder_name_from_prompt,
+                             unique_prompts)
+from image_title_creator import ImageTitleCreator
+from progress_index import ProgressIndex
+from results_store import ResultsStore, set_name
+
+OUTPUT_FOLDERS = ("output_middle", "output_advanced")
+# Every stage depends on the previous one
+STAGES = ("generate", "interrogate", "evaluate")
+
+
+def digest(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def file_digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class PipelineGraph:
+    """
+    The generate -> interrogate -> evaluate stage graph behind `pipeline.py all`.
+    Every concept gets, for every stage, the hash of the inputs it was produced from: its prompt, the steps,
+    the seeds, the negative prompt and the model ids, chained with the hash of the same concept in the previous stage.
+    The hashes of the concepts that went through a stage are recorded in pipeline_state.json, so a rerun
+    redoes a concept only in the stages whose inputs changed (and in the following ones), or that never finished.
+    """
+
+    def __init__(self, steps: int = 30, backend: str = "sd", synsets_path: str = "synsets.txt",
+                 hyponyms_path: str = "hyponyms.txt", state_path: str = "pipeline_state.json",
+                 results_path: str = "results.npz") -> None:
+        from diffusion_backends import get_backend
+        from interrogate_images import CAPTION_MODEL, CAPTION_MODEL_TYPE, NUM_CAPTIONS, SEED as CAPTION_SEED
+        from sentence_embedding_cache import SENTENCE_MODEL
+        titles = ImageTitleCreator(synsets_path, hyponyms_path)
+        # A prompt listed twice is a single concept
+        self.prompt_lists = dict(zip(OUTPUT_FOLDERS, (unique_prompts(titles.get_synset_titles()),
+                                                      unique_prompts(titles.get_hyponym_titles()))))
+        self.results_path = results_path
+        self.state_path = state_path
+        # The inputs of each stage, besides the concepts themselves
+        self.inputs = {
+            "generate": {"synsets": file_digest(synsets_path), "hyponyms": file_digest(hyponyms_path),
+                         "backend": backend, "weights": get_backend(backend).weights, "steps": steps, "seed": SEED,
+                         "negative_prompt": NEGATIVE_PROMPT, "prompt_template": "{concept}",
+                         "images_per_prompt": IMAGES_PER_PROMPT},
+            "interrogate": {"caption_model": f"{CAPTION_MODEL}:{CAPTION_MODEL_TYPE}", "ranking_model": SENTENCE_MODEL,
+                            "seed": CAPTION_SEED, "captions": NUM_CAPTIONS},
+            "evaluate": {"model": SENTENCE_MODEL},
+        }
+        self.state = {stage: {"inputs": {}, "concepts": {}} for stage in STAGES}
+        if os.path.exists(state_path):
+            with open(state_path, "r") as f:
+                self.state.update(json.load(f))
+        self.hashes = self._concept_hashes()
+
+    def concepts(self) -> list:
+        """
+        Returns the (output folder, prompt) of every concept
+        """
+        return [(output_folder, prompt) for output_folder, prompt_list in self.prompt_lists.items()
+                for prompt in prompt_list]
+
+    @staticmethod
+    def key(output_folder: str, prompt: str) -> str:
+        return f"{output_folder}/{folder_name_from_prompt(prompt)}"
+
+    def _concept_hashes(self) -> dict:
+        """
+        Returns {stage: {concept key: hash of its inputs}}. The synsets and hyponyms files are left out:
+        a concept only depends on its own prompt (its images are named after their number in the concept folder,
+        not after the position of the prompt), so editing, inserting or removing one line does not invalidate
+        the others.
+        """
+        generate = dict(self.inputs["generate"])
+        for name in ("synsets", "hyponyms"):
+            generate.pop(name)
+        hashes = {stage: {} for stage in STAGES}
+        for output_folder, prompt in self.concepts():
+            key = self.key(output_folder, prompt)
+            hashes["generate"][key] = digest([generate, prompt])
+            hashes["interrogate"][key] = digest([hashes["generate"][key], self.inputs["interrogate"]])
+            hashes["evaluate"][key] = digest([hashes["interrogate"][key], self.inputs["evaluate"]])
+        return hashes
+
+    def is_done(self, stage: str) -> dict:
+        """
+        Returns {concept key: whether the outputs of stage are on disk} for every concept
+        """
+        done = {}
+        if stage == "generate":
+            for output_folder in OUTPUT_FOLDERS:
+                completed = GenerationManifest.completed_images(output_folder)
+                for prompt in self.prompt_lists[output_folder]:
+                    done[self.key(output_folder, prompt)] = concept_done(completed, folder_name_from_prompt(prompt))
+            return done
+        results = ResultsStore(self.results_path)
+        for output_folder, prompt in self.concepts():
+            folder = folder_name_from_prompt(prompt)
+            if stage == "interrogate":
+                done[self.key(output_folder, prompt)] = os.path.exists(
+                    os.path.join(output_folder, folder, "interrogations.txt"))
+            else:
+                done[self.key(output_folder, prompt)] = results.has(set_name(output_folder), folder)
+        return done
+
+    def plan(self) -> dict:
+        """
+        Returns {stage: (stale concept keys, concept keys to run)}: a concept is stale when its recorded hash
+        differs from the current one, and runs when it is stale, or not done, or stale in an earlier stage
+        """
+        plan = {}
+        upstream = set()
+        for stage in STAGES:
+            stale = self.changed(stage) | upstream
+            done = self.is_done(stage)
+            plan[stage] = (stale, stale | {key for key, value in done.items() if not value})
+            upstream = plan[stage][1]
+        return plan
+
+    def changed(self, stage: str) -> set:
+        """
+        Returns the keys of the concepts whose recorded hash for stage differs from the current one
+        """
+        recorded = self.state[stage]["concepts"]
+        return {key for key, value in self.hashes[stage].items() if key in recorded and recorded[key] != value}
+
+    def report(self, plan: dict) -> None:
+        """
+        Prints what a run would do, with the stage inputs that changed since the last run
+        """
+        for stage in STAGES:
+            stale, to_run = plan[stage]
+            changed = [name for name, value in self.inputs[stage].items()
+                       if self.state[stage]["inputs"].get(name, value) != value]
+            status = f"{len(to_run)} concepts to run ({len(self.changed(stage))} with changed inputs)" if to_run \
+                else "up to date"
+            print(f"{stage}: {status}" + (f", changed inputs: {', '.join(changed)}" if changed else ""))
+            for key in sorted(to_run)[:10]:
+                print(f"    {key}")
+            if len(to_run) > 10:
+                print(f"    ... and {len(to_run) - 10} more")
+
+    def invalidate(self, stage: str, stale: set) -> None:
+        """
+        Removes the outputs of the stale concepts of stage, so the stage produces them again
+        """
+        if not stale:
+            return
+        progress = ProgressIndex()
+        for output_folder in OUTPUT_FOLDERS:
+            folders = {key.split("/", 1)[1] for key in stale if key.split("/", 1)[0] == output_folder}
+            if not folders:
+                continue
+            progress.forget(stage, output_folder, sorted(folders))
+            if stage == "generate":
+                GenerationManifest.forget(output_folder, folders)
+            elif stage == "interrogate":
+                for folder in folders:
+                    path = os.path.join(output_folder, folder, "interrogations.txt")
+                    if os.path.exists(path):
+                        os.remove(path)
+            else:
+                results = ResultsStore(self.results_path)
+                for folder in folders:
+                    results.remove(set_name(output_folder), folder)
+                results.save()
+        progress.close()
+        for key in stale:
+            self.state[stage]["concepts"].pop(key, None)
+        self.save_state()
+
+    def record(self, stage: str) -> None:
+        """
+        Records the current hashes of the concepts whose outputs of stage are on disk
+        """
+        self.state[stage]["inputs"] = self.inputs[stage]
+        for key, value in self.is_done(stage).items():
+            if value:
+                self.state[stage]["concepts"][key] = self.hashes[stage][key]
+        self.save_state()
+
+    def save_state(self) -> None:
+        with open(f"{self.state_path}.tmp", "w") as f:
+            json.dump(self.state, f)
+        os.replace(f"{self.state_path}.tmp", self.state_path)
+
+    def run(self, stages: dict, dry_run: bool = False) -> None:
+        """
+        Runs the stages that have concepts to run, stages being {stage: function running it}.
+        Every stage function processes whatever is missing on disk, which invalidate() arranges to be exactly
+        the concepts to run. With dry_run, only reports what would run.
+        """
+        plan = self.plan()
+        self.report(plan)
+        if dry_run:
+            return
+        for stage in STAGES:
+            stale, to_run = plan[stage]
+            if to_run:
+                self.invalidate(stage, stale)
+                stages[stage]()
+            self.record(stage)
@@ -0,0 +1,161 @@
+import os
+import time
+
+from sqlite_database import SQLiteDatabase
+
+PROGRESS_PATH = os.environ.get("PIPELINE_PROGRESS", "progress.sqlite")
+STAGES = ("generate", "interrogate", "evaluate")
+
+
+class ProgressIndex:
+    """
+    Persistent index of the progress of a run: one row per (stage, output folder, concept) that a stage completed
+    or failed, with the time of the event and the error of the failures.
+    Every stage updates it as it goes (generate once all the images of a concept are on disk, interrogate once
+    its interrogations are picked, evaluate once its scores are in the results store), so `pipeline.py status`
+    reads progress from this single file instead of walking thousands of concept folders.
+    Like the sentence embedding cache, several processes (the sharded workers) and threads (the image writer)
+    can update it, taking turns in SQLite write transactions.
+    """
+
+    def __init__(self, path: str = PROGRESS_PATH) -> None:
+        self.path = path
+        self.db = SQLiteDatabase(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS progress (stage TEXT, output_folder TEXT, concept TEXT,"
+                        " status TEXT, updated REAL, error TEXT, PRIMARY KEY (stage, output_folder, concept))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS progress_updated ON progress (stage, status, updated)")
+
+    def _set(self, stage: str, output_folder: str, concepts: list, status: str, error: str = None) -> None:
+        now = time.time()
+        with self.db.transaction():
+            self.db.executemany("INSERT OR REPLACE INTO progress VALUES (?, ?, ?, ?, ?, ?)",
+                                [(stage, os.path.normpath(output_folder), concept, status, now, error)
+                                 for concept in concepts])
+
+    def done(self, stage: str, output_folder: str, concepts: list) -> None:
+        """
+        Records that stage completed the concept folders concepts of output_folder
+        """
+        self._set(stage, output_folder, concepts, "done")
+
+    def failed(self, stage: str, output_folder: str, concepts: list, error) -> None:
+        """
+        Records that stage failed on the concept folders concepts of output_folder, because of error
+        """
+        self._set(stage, output_folder, concepts, "failed", f"{type(error).__name__}: {error}")
+
+    def forget(self, stage: str, output_folder: str, concepts: list) -> None:
+        """
+        Drops the progress of concepts in stage, e.g. when their outputs are invalidated
+        """
+        with self.db.transaction():
+            self.db.executemany("DELETE FROM progress WHERE stage = ? AND output_folder = ? AND concept = ?",
+                                [(stage, os.path.normpath(output_folder), concept) for concept in concepts])
+
+    def counts(self, stage: str, concepts: dict = None) -> dict:
+        """
+        Returns {(output folder, status): number of concepts} for stage, only counting the concept folders of
+        concepts ({output folder: set of concept folders}) when given
+        """
+        if concepts is None:
+            return {(output_folder, status): count for output_folder, status, count in self.db.execute(
+                "SELECT output_folder, status, COUNT(*) FROM progress WHERE stage = ? GROUP BY output_folder, status",
+                (stage,))}
+        counts = {}
+        for output_folder, concept, status in self.db.execute(
+                "SELECT output_folder, concept, status FROM progress WHERE stage = ?", (stage,)):
+            if concept in concepts.get(output_folder, ()):
+                counts[(output_folder, status)] = counts.get((output_folder, status), 0) + 1
+        return counts
+
+    def failures(self, stage: str, concepts: dict = None) -> list:
+        """
+        Returns the (output folder, concept, error) of the concepts stage failed on, most recent first,
+        only the concept folders of concepts ({output folder: set of concept folders}) when given
+        """
+        failures = self.db.execute("SELECT output_folder, concept, error FROM progress"
+                                   " WHERE stage = ? AND status = 'failed' ORDER BY updated DESC", (stage,)).fetchall()
+        if concepts is None:
+            return failures
+        return [failure for failure in failures if failure[1] in concepts.get(failure[0], ())]
+
+    def throughput(self, stage: str, window: int = 50) -> float:
+        """
+        Returns the concepts per second of stage over its last window completions (None when unknown)
+        """
+        times = [updated for updated, in self.db.execute(
+            "SELECT updated FROM progress WHERE stage = ? AND status = 'done' ORDER BY updated DESC LIMIT ?",
+            (stage, window))]
+        if len(times) < 2 or times[0] == times[-1]:
+            return None
+        return (len(times) - 1) / (times[0] - times[-1])
+
+    def rebuild(self, prompt_lists: dict, results_path: str = "results.npz") -> None:
+        """
+        Rebuilds the index from the outputs on disk, for runs started before the index existed
+        or after outputs were removed by hand. prompt_lists is {output folder: prompt list}.
+        """
+        from generation_manifest import GenerationManifest
+        from image_generator import concept_done, folder_name_from_prompt, unique_prompts
+        from results_store import ResultsStore, set_name
+        results = ResultsStore(results_path)
+        done = {stage: [] for stage in STAGES}
+        for output_folder, prompt_list in prompt_lists.items():
+            completed = GenerationManifest.completed_images(output_folder)
+            for prompt in unique_prompts(prompt_list):
+                concept = folder_name_from_prompt(prompt)
+                if concept_done(completed, concept):
+                    done["generate"].append((output_folder, concept))
+                if os.path.exists(os.path.join(output_folder, concept, "interrogations.txt")):
+                    done["interrogate"].append((output_folder, concept))
+                if results.has(set_name(output_folder), concept):
+                    done["evaluate"].append((output_folder, concept))
+        now = time.time()
+        with self.db.transaction():
+            # The failures are kept, unless the concept has been done since
+            self.db.execute("DELETE FROM progress WHERE status = 'done'")
+            for stage, concepts in done.items():
+                self.db.executemany("INSERT OR REPLACE INTO progress VALUES (?, ?, ?, 'done', ?, NULL)",
+                                    [(stage, os.path.normpath(output_folder), concept, now)
+                                     for output_folder, concept in concepts])
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def format_duration(seconds: float) -> str:
+    hours, rest = divmod(int(seconds), 3600)
+    return f"{hours}h {rest // 60:02d}m" if hours else f"{rest // 60}m {rest % 60:02d}s"
+
+
+def status(path: str = PROGRESS_PATH, prompt_lists: dict = None, max_failures: int = 10) -> None:
+    """
+    Prints, for every stage, the completed, failed and pending concepts of each output folder, the ETA of the stage
+    at its recent throughput and the concepts it failed on. prompt_lists ({output folder: prompt list})
+    gives the concepts of each folder: the progress of the concepts no longer in the lists is left out.
+    """
+    from image_generator import folder_name_from_prompt, unique_prompts
+    index = ProgressIndex(path)
+    concepts = {os.path.normpath(output_folder): {folder_name_from_prompt(prompt)
+                                                  for prompt in unique_prompts(prompt_list)}
+                for output_folder, prompt_list in prompt_lists.items()}
+    totals = {output_folder: len(folder_concepts) for output_folder, folder_concepts in concepts.items()}
+    for stage in STAGES:
+        counts = index.counts(stage, concepts)
+        done = sum(counts.get((output_folder, "done"), 0) for output_folder in totals)
+        failed = sum(counts.get((output_folder, "failed"), 0) for output_folder in totals)
+        pending = sum(totals.values()) - done - failed
+        rate = index.throughput(stage)
+        # The failed concepts are redone by the next run
+        eta = f", ETA {format_duration((pending + failed) / rate)} at {rate * 60:.1f} concepts/min" \
+            if pending + failed and rate else ""
+        print(f"{stage}: {done}/{sum(totals.values())} done, {pending} pending, {failed} failed{eta}")
+        for output_folder, total in totals.items():
+            print(f"    {output_folder}: {counts.get((output_folder, 'done'), 0)}/{total} done, "
+                  f"{counts.get((output_folder, 'failed'), 0)} failed")
+        failures = index.failures(stage, concepts)
+        for output_folder, concept, error in failures[:max_failures]:
+            print(f"    failed {output_folder}/{concept}: {error}")
+        if len(failures) > max_failures:
+            print(f"    ... and {len(failures) - max_failures} more failures")
+    index.close()
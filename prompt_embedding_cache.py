@@ -0,0 +1,77 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import torch
+
+
+class PromptEmbeddingCache:
+    """
+    On-disk cache of the text embeddings used by Stable Diffusion (see DiffusionBackend.encode_text).
+    Every embedding is stored in its own file, keyed by the weights id, the dtype, the tokenizer and the text,
+    so reruns and steps/guidance experiments never run the text encoder twice on the same prompt.
+    The max_memory_entries most recently used embeddings are also kept in memory, on the backend's device,
+    so the fixed negative prompt is encoded once per process; the others are read back from disk.
+    A Stable Diffusion embedding takes about 118 KB, so a run over every concept cannot keep all of them.
+    """
+
+    def __init__(self, backend, cache_dir: str = "cache/prompt_embeddings", max_memory_entries: int = 256) -> None:
+        self.backend = backend
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.tokenizer_id = backend.tokenizer_id()
+        self.max_memory_entries = max_memory_entries
+        self.memory = OrderedDict()
+
+    def get(self, texts: list) -> torch.Tensor:
+        """
+        Returns the embeddings of texts as a (len(texts), tokens, hidden) tensor on the backend's device.
+        Texts that are neither in memory nor on disk are encoded together in a single text encoder pass.
+        """
+        # Kept aside, as a batch larger than max_memory_entries evicts its own first embeddings from memory
+        embeddings = {}
+        missing = []
+        for text in dict.fromkeys(texts):
+            embedding = self._lookup(text)
+            if embedding is None:
+                missing.append(text)
+            else:
+                embeddings[text] = embedding
+        if missing:
+            for text, embedding in zip(missing, self.backend.encode_text(missing)):
+                self._store(text, embedding)
+                embeddings[text] = embedding
+        return torch.stack([embeddings[text] for text in texts])
+
+    def _key(self, text: str) -> str:
+        key = f"{self.backend.weights}\n{self.backend.dtype}\n{self.tokenizer_id}\n{text}"
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _path(self, text: str) -> str:
+        return os.path.join(self.cache_dir, f"{self._key(text)}.pt")
+
+    def _lookup(self, text: str):
+        """
+        Returns the embedding of text from memory or from disk, or None when it is not cached
+        """
+        if text in self.memory:
+            self.memory.move_to_end(text)
+            return self.memory[text]
+        path = self._path(text)
+        if not os.path.exists(path):
+            return None
+        embedding = torch.load(path).to(self.backend.device, dtype=self.backend.dtype)
+        self._remember(text, embedding)
+        return embedding
+
+    def _remember(self, text: str, embedding: torch.Tensor) -> None:
+        self.memory[text] = embedding
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def _store(self, text: str, embedding: torch.Tensor) -> None:
+        self._remember(text, embedding)
+        # Write to a temporary file first, so an interrupted run never leaves a truncated embedding behind
+        path = self._path(text)
+        torch.save(embedding.detach().cpu(), f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
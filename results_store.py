@@ -0,0 +1,134 @@
+import os
+
+import numpy as np
+
+COLUMNS = ("concept", "set", "image", "caption", "score")
+
+
+def set_name(output_folder: str) -> str:
+    """
+    Name of the set of the concepts of an output folder: output_middle -> middle, output_advanced -> advanced
+    """
+    return os.path.basename(os.path.normpath(output_folder)).replace("output_", "")
+
+
+class ResultsStore:
+    """
+    Columnar store of the evaluation of a whole run, a single results.npz next to the output folders.
+    Each row is one image: its concept folder, its set (middle or advanced), its image index (the line of
+    interrogations.txt), its caption and the cosine similarity between the caption and the concept name.
+    The columns are plain numpy arrays, so the analyzers load the whole run at once instead of crawling
+    thousands of cosine_scores.txt files.
+    Updated concepts are kept aside and merged into the columns once, when they are next read or saved,
+    so scoring a run concept by concept does not copy every column for every concept.
+    """
+
+    def __init__(self, path: str = "results.npz") -> None:
+        self.path = path
+        if os.path.exists(path):
+            with np.load(path) as data:
+                self.columns = {column: data[column] for column in COLUMNS}
+        else:
+            self.columns = {"concept": np.array([], dtype=str), "set": np.array([], dtype=str),
+                            "image": np.array([], dtype=np.int32), "caption": np.array([], dtype=str),
+                            "score": np.array([], dtype=np.float32)}
+        # The (set, concept) pairs that have rows, including the pending ones
+        self.concepts = set(zip(self.columns["set"].tolist(), self.columns["concept"].tolist()))
+        # {(set, concept): its new rows} of the updates not merged into the columns yet
+        self.pending = {}
+
+    def __len__(self) -> int:
+        return len(self._merged()["score"])
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self._merged()[column]
+
+    def has(self, set_name: str, concept: str) -> bool:
+        return (set_name, concept) in self.concepts
+
+    def concept_scores(self, set_name: str = None) -> dict:
+        """
+        Returns {concept: scores of its images, ordered by image index} for the concepts of set_name
+        (of every set when set_name is None: a concept that is in both sets keeps its middle scores)
+        """
+        columns = self._merged()
+        order = np.lexsort((columns["image"], columns["concept"], columns["set"] != "middle"))
+        if set_name is not None:
+            order = order[columns["set"][order] == set_name]
+        if not len(order):
+            return {}
+        concepts, scores = columns["concept"][order], columns["score"][order]
+        # Rows of the same (set, concept) are contiguous after the sort
+        starts = np.flatnonzero(np.r_[True, (concepts[1:] != concepts[:-1])
+                                      | (columns["set"][order][1:] != columns["set"][order][:-1])])
+        result = {}
+        for start, end in zip(starts, np.r_[starts[1:], len(order)]):
+            result.setdefault(str(concepts[start]), scores[start:end])
+        return result
+
+    def mean_scores(self, set_name: str = None) -> dict:
+        """
+        Returns {concept: mean score of its images}, see concept_scores
+        """
+        return {concept: float(scores.mean()) for concept, scores in self.concept_scores(set_name).items()}
+
+    def update(self, set_name: str, concept: str, captions: list, scores: list) -> None:
+        """
+        Replaces the rows of a concept of set_name with one row per (caption, score), in image order.
+        Call save() to write the store.
+        """
+        self.pending[(set_name, concept)] = {
+            "concept": np.asarray([concept] * len(scores), dtype=str),
+            "set": np.asarray([set_name] * len(scores), dtype=str),
+            "image": np.arange(len(scores), dtype=np.int32),
+            "caption": np.asarray([caption.strip() for caption in captions], dtype=str),
+            "score": np.asarray(scores, dtype=np.float32)}
+        if len(scores):
+            self.concepts.add((set_name, concept))
+        else:
+            self.concepts.discard((set_name, concept))
+
+    def _merged(self) -> dict:
+        """
+        Returns the columns, after merging the pending updates into them in a single concatenation
+        """
+        if self.pending:
+            keys = np.char.add(np.char.add(self.columns["set"], "/"), self.columns["concept"])
+            keep = ~np.isin(keys, [f"{set_name}/{concept}" for set_name, concept in self.pending])
+            for column in COLUMNS:
+                self.columns[column] = np.concatenate([self.columns[column][keep]]
+                                                      + [rows[column] for rows in self.pending.values()])
+            self.pending = {}
+        return self.columns
+
+    def remove(self, set_name: str, concept: str) -> None:
+        """
+        Drops the rows of a concept of set_name, call save() to write the store
+        """
+        self.update(set_name, concept, [], [])
+
+    def save(self) -> None:
+        # Write to a temporary file first, so an interrupted run never leaves a truncated store behind
+        with open(f"{self.path}.tmp", "wb") as f:
+            np.savez(f, **self._merged())
+        os.replace(f"{self.path}.tmp", self.path)
+
+
+def import_text_files(output_folders: list, path: str = "results.npz") -> ResultsStore:
+    """
+    Builds the results store of a run that was evaluated with per-folder text files,
+    from the interrogations.txt and cosine_scores.txt of every concept folder of output_folders
+    """
+    store = ResultsStore(path)
+    for output_folder in output_folders:
+        for folder in sorted(os.listdir(output_folder)):
+            scores_file = os.path.join(output_folder, folder, "cosine_scores.txt")
+            if not os.path.exists(scores_file):
+                continue
+            with open(scores_file, "r") as f:
+                scores = [float(line) for line in f.readlines() if not line.startswith("Mean")]
+            with open(os.path.join(output_folder, folder, "interrogations.txt"), "r") as f:
+                captions = f.readlines()
+            store.update(set_name(output_folder), folder, captions, scores)
+    store.save()
+    return store
@@ -0,0 +1,77 @@
+import os
+from collections import Counter
+
+import numpy as np
+
+# Next to the other caches of the repository, whatever the directory the scripts run from
+INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "semcor_frequencies.npz")
+
+
+class SemcorFrequencyIndex:
+    """
+    How often every WordNet synset is a possible sense of a SemCor token, i.e. the Counter of wn.synsets(word)
+    over semcor.words(), as used to rank synsets by frequency by term_extractor and synset_selector.
+    It is built once: wn.synsets is called once per distinct word form (SemCor has about 800k tokens but
+    a few tens of thousands of forms) and its synsets are counted as many times as the form occurs.
+    The index is stored as sorted columns (synset name, count, part of speech) in a single npz,
+    so loading it takes milliseconds and the top-k queries are slices.
+    """
+
+    def __init__(self, path: str = INDEX_PATH) -> None:
+        if not os.path.exists(path):
+            self.build(path)
+        with np.load(path) as data:
+            self.names = data["synset"]
+            self.counts = data["count"]
+            self.pos = data["pos"]
+        self.rows = {name: row for row, name in enumerate(self.names.tolist())}
+
+    @staticmethod
+    def build(path: str = INDEX_PATH) -> None:
+        """
+        Counts the synsets of the SemCor tokens and writes the index to path
+        """
+        from nltk.corpus import semcor
+        from nltk.corpus import wordnet as wn
+        print("Building the SemCor frequency index (only once)")
+        forms = Counter(semcor.words())
+        counts = Counter()
+        for form, occurrences in forms.items():
+            for synset in wn.synsets(form):
+                counts[synset.name()] += occurrences
+        # Most frequent first, ties broken by name so the order never depends on the corpus reader
+        names = sorted(counts, key=lambda name: (-counts[name], name))
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Write to a temporary file first, so an interrupted build never leaves a truncated index behind
+        with open(f"{path}.tmp", "wb") as f:
+            np.savez(f, synset=np.asarray(names, dtype=str),
+                     count=np.asarray([counts[name] for name in names], dtype=np.int64),
+                     pos=np.asarray([name.rsplit(".", 2)[1] for name in names], dtype=str))
+        os.replace(f"{path}.tmp", path)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def frequency(self, synset) -> int:
+        """
+        Returns the number of SemCor tokens synset (a Synset or its name) is a possible sense of
+        """
+        row = self.rows.get(synset if isinstance(synset, str) else synset.name())
+        return 0 if row is None else int(self.counts[row])
+
+    def most_common(self, k: int = None, pos: str = None) -> list:
+        """
+        Returns the (synset, count) pairs of the k most frequent synsets (all of them when k is None),
+        of part of speech pos only when given
+        """
+        from nltk.corpus import wordnet as wn
+        rows = np.flatnonzero(self.pos == pos) if pos is not None else np.arange(len(self.names))
+        return [(wn.synset(name), int(count)) for name, count in zip(self.names[rows[:k]].tolist(),
+                                                                   self.counts[rows[:k]].tolist())]
+
+    def sort_by_frequency(self, synsets) -> list:
+        """
+        Returns synsets from the most to the least frequent, leaving out the ones that never occur in SemCor
+        """
+        return sorted((synset for synset in synsets if self.frequency(synset)),
+                      key=lambda synset: self.rows[synset.name()])
@@ -0,0 +1,144 @@
+import hashlib
+import os
+import threading
+import time
+
+import numpy as np
+import torch
+
+from model_registry import sentence_model
+from sqlite_database import SQLiteDatabase
+from telemetry import ModelCall
+
+# Sentence embedding model used to rank and score the captions
+SENTENCE_MODEL = "all-MiniLM-L6-v2"
+# The registry hands the same model to every cache of the process, and SentenceTransformer.encode is not thread-safe:
+# threads encoding at the same time (the interrogator and the scorer of interrogate-evaluate) take turns
+ENCODE_LOCK = threading.Lock()
+
+
+class SentenceEmbeddingCache:
+    """
+    Persistent, content-addressed cache of the sentence embeddings used to rank and score captions
+    (see ImageInterrogator.rank_captions and Evaluation.compute_cosine_scores).
+    Embeddings are keyed by (model name, normalized text): the vectors live in a float16 memory-mapped matrix
+    with one file per model, and an SQLite index maps every text to its row and its last use.
+    Every access to the matrix happens inside an SQLite write transaction, so several processes can share the cache,
+    and threads of the same process take turns on its connection.
+    The matrix holds at most max_entries texts per model, the least recently used ones being evicted to make room.
+    Missing texts are encoded in batches of batch_size texts of similar length, so little work is spent on padding.
+    Without a model, the model called model_name is only loaded (through the model registry) when a text is missing,
+    so a rerun whose texts are all cached never loads it.
+    """
+
+    def __init__(self, model, model_name: str, cache_dir: str = "cache/sentence_embeddings",
+                 max_entries: int = 200_000, batch_size: int = 64) -> None:
+        self._model = model
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        os.makedirs(cache_dir, exist_ok=True)
+        model_id = hashlib.sha256(model_name.encode("utf-8")).hexdigest()[:16]
+        self.matrix_path = os.path.join(cache_dir, f"{model_id}.npy")
+        self.matrix = None
+        self.db = SQLiteDatabase(os.path.join(cache_dir, "index.sqlite"))
+        self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (model TEXT, text TEXT, slot INTEGER, last_used REAL,"
+                        " PRIMARY KEY (model, text))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS embeddings_lru ON embeddings (model, last_used)")
+
+    @property
+    def model(self):
+        # Not kept here: the registry may unload the model to stay within its budget
+        return self._model if self._model is not None else sentence_model(self.model_name)
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.split())
+
+    def encode(self, texts: list) -> torch.Tensor:
+        """
+        Returns the (len(texts), dim) float32 embeddings of texts.
+        Repeated texts are encoded once, and only the texts missing from the cache reach the model.
+        Fresh embeddings are rounded to float16 like the cached ones, so a score does not depend on whether
+        its texts were in the cache.
+        """
+        unique = list(dict.fromkeys(self.normalize(text) for text in texts))
+        embeddings = self._lookup(unique)
+        missing = sorted((text for text in unique if text not in embeddings), key=len)
+        for start in range(0, len(missing), self.batch_size):
+            bucket = missing[start:start + self.batch_size]
+            with ENCODE_LOCK, ModelCall(self.model_name, len(bucket)):
+                encoded = self.model.encode(bucket, batch_size=len(bucket), convert_to_numpy=True)
+            encoded = encoded.astype(np.float16).astype(np.float32)
+            embeddings.update(zip(bucket, encoded))
+            self._insert(bucket, encoded)
+        return torch.from_numpy(np.stack([embeddings[self.normalize(text)] for text in texts]))
+
+    def _lookup(self, texts: list) -> dict:
+        """
+        Returns {text: embedding} for the texts of texts that are cached, marking them as just used
+        """
+        if not os.path.exists(self.matrix_path):
+            return {}
+        with self.db.transaction():
+            matrix = self._open_matrix()
+            slots = self._slots(texts)
+            found = {text: matrix[slot].astype(np.float32) for text, slot in slots.items()}
+            now = time.time()
+            self.db.executemany("UPDATE embeddings SET last_used = ? WHERE model = ? AND text = ?",
+                                [(now, self.model_name, text) for text in slots])
+        return found
+
+    def _slots(self, texts: list) -> dict:
+        """
+        Returns {text: matrix row} for the texts of texts that are in the index
+        """
+        return dict(self.db.select_in("SELECT text, slot FROM embeddings WHERE model = ? AND text IN ({})",
+                                      (self.model_name,), texts))
+
+    def _insert(self, texts: list, embeddings: np.ndarray) -> None:
+        """
+        Stores the embeddings of texts, evicting the least recently used texts when the matrix is full
+        """
+        with self.db.transaction():
+            matrix = self._open_matrix(embeddings.shape[1])
+            # Another process may have cached some of these texts in the meantime
+            cached = self._slots(texts)
+            new = [(text, embedding) for text, embedding in zip(texts, embeddings) if text not in cached]
+            new = new[:self.max_entries]
+            used = self.db.execute("SELECT COUNT(*) FROM embeddings WHERE model = ?", (self.model_name,)).fetchone()[0]
+            # Slots 0..used-1 are always taken: free slots come first, then the slots of the evicted texts
+            slots = list(range(used, min(used + len(new), self.max_entries)))
+            evicted = self.db.execute("SELECT text, slot FROM embeddings WHERE model = ? ORDER BY last_used LIMIT ?",
+                                      (self.model_name, len(new) - len(slots))).fetchall()
+            self.db.executemany("DELETE FROM embeddings WHERE model = ? AND text = ?",
+                                [(self.model_name, text) for text, _ in evicted])
+            slots += [slot for _, slot in evicted]
+            for slot, (_, embedding) in zip(slots, new):
+                matrix[slot] = embedding
+            matrix.flush()
+            now = time.time()
+            self.db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+                                [(self.model_name, text, slot, now) for slot, (text, _) in zip(slots, new)])
+
+    def _open_matrix(self, dim: int = None) -> np.memmap:
+        """
+        Maps the matrix of the model, creating it (with dim columns) when it does not exist yet.
+        The rows of the index without a row in the matrix (all of them when the matrix file has been removed)
+        are dropped, so a text is never served the zeros of an empty row.
+        Must be called inside a transaction, so only one process creates the file.
+        """
+        if self.matrix is None:
+            if not os.path.exists(self.matrix_path):
+                np.lib.format.open_memmap(f"{self.matrix_path}.tmp", mode="w+", dtype=np.float16,
+                                          shape=(self.max_entries, dim)).flush()
+                os.replace(f"{self.matrix_path}.tmp", self.matrix_path)
+                self.db.execute("DELETE FROM embeddings WHERE model = ?", (self.model_name,))
+            self.matrix = np.load(self.matrix_path, mmap_mode="r+")
+            # The matrix may have been created by a process with another limit
+            self.max_entries = self.matrix.shape[0]
+            self.db.execute("DELETE FROM embeddings WHERE model = ? AND slot >= ?", (self.model_name, self.max_entries))
+        return self.matrix
+
+    def close(self) -> None:
+        self.db.close()
@@ -0,0 +1,140 @@
+import multiprocessing as mp
+import os
+import queue
+
+from tqdm import tqdm
+
+from generation_manifest import GenerationManifest
+from image_generator import IMAGES_PER_PROMPT, concept_done, folder_name_from_prompt, unique_prompts
+from latent_store import LatentStore
+from telemetry import Stage, run_id
+
+
+def build_image_generator(folder_name: str, device: str, image_format: str = "png", backend: str = "sd",
+                          store_latents=False):
+    """
+    Default worker factory: one ImageGenerator with its own backend on the worker's device
+    """
+    from diffusion_backends import get_backend
+    from image_generator import ImageGenerator
+    from image_writer import ImageWriter
+    # A worker is only built once it has a concept to render: the model loads while the manifest is read
+    return ImageGenerator([], folder_name=folder_name, writer=ImageWriter(image_format=image_format), device=device,
+                          backend=get_backend(backend, device), store_latents=store_latents, preload=True)
+
+
+def plan_concepts(prompt_lists: dict, latent_backend=None) -> list:
+    """
+    Given a dict {output folder: prompt list}, returns the (output folder, prompt) concepts
+    that still miss at least one image according to the manifests.
+    When latent_backend is given, the latent stores the workers write into are created for its latent shape.
+    """
+    concepts = []
+    for folder_name, prompt_list in prompt_lists.items():
+        prompt_list = unique_prompts(prompt_list)
+        os.makedirs(folder_name, exist_ok=True)
+        if latent_backend is not None:
+            LatentStore.create(folder_name, [folder_name_from_prompt(prompt) for prompt in prompt_list],
+                               IMAGES_PER_PROMPT, latent_backend.latent_shape, latent_backend.weights)
+        manifest = GenerationManifest(folder_name)
+        for prompt in prompt_list:
+            if not concept_done(manifest.completed, folder_name_from_prompt(prompt)):
+                concepts.append((folder_name, prompt))
+        manifest.close()
+    return concepts
+
+
+def _take_batch(tasks, first, batch_size: int) -> tuple:
+    """
+    Takes up to batch_size concepts of the same output folder from the shared queue without waiting.
+    Returns the batch and a list with the task that did not fit in it (if any), to be processed next:
+    that task may also be the end-of-work sentinel.
+    """
+    batch = [first]
+    while len(batch) < batch_size:
+        try:
+            task = tasks.get_nowait()
+        except queue.Empty:
+            break
+        if task is None or task[0] != first[0]:
+            return batch, [task]
+        batch.append(task)
+    return batch, []
+
+
+def _worker(device: str, factory, steps: int, batch_size: int, tasks, done) -> None:
+    """
+    Worker process: owns one pipeline and keeps pulling concepts from the shared queue until it finds a sentinel,
+    so faster devices naturally take more work
+    """
+    generator = None
+    task = tasks.get()
+    try:
+        while task is not None:
+            batch, left_over = _take_batch(tasks, task, batch_size)
+            folder_name = task[0]
+            if generator is None:
+                generator = factory(folder_name, device)
+            elif generator.folder_name != folder_name:
+                generator.set_folder_name(folder_name)
+            generator.generate_concepts([prompt for _, prompt in batch], steps=steps)
+            done.put(len(batch))
+            task = left_over[0] if left_over else tasks.get()
+    finally:
+        if generator is not None:
+            generator.close()
+            generator.writer.close()
+
+
+def generate_sharded(prompt_lists: dict, devices: list, factory=build_image_generator, steps=30, batch_size=1,
+                     latent_backend=None) -> None:
+    """
+    Generates the images of every {output folder: prompt list} with one worker process per device.
+    Workers share a single queue of concepts, write into the usual output folders and record their images
+    in the same manifests, so a sharded run can be resumed by a sharded or a serial run and vice versa.
+    factory(folder_name, device) builds the worker's ImageGenerator and must be picklable (a module level function
+    or a functools.partial of one): partial(build_image_generator, backend="fake") runs the whole mode
+    on a CPU-only box.
+    When the workers store latents, latent_backend (an unloaded instance of their backend) must be given.
+    """
+    concepts = plan_concepts(prompt_lists, latent_backend)
+    if not concepts:
+        print("Nothing to generate")
+        return
+    # The workers inherit the run id, so their records belong to this run
+    run_id()
+    # CUDA cannot be re-initialized in a forked process
+    ctx = mp.get_context("spawn")
+    tasks, done = ctx.Queue(), ctx.Queue()
+    for concept in concepts:
+        tasks.put(concept)
+    for _ in devices:
+        tasks.put(None)
+    workers = [ctx.Process(target=_worker, args=(device, factory, steps, batch_size, tasks, done))
+               for device in devices]
+    for worker in workers:
+        worker.start()
+
+    pbar = tqdm(total=len(concepts), desc=f"Generating on {len(devices)} workers")
+    completed = 0
+    with Stage("generate-sharded", workers=len(devices), batch_size=batch_size, steps=steps) as stage:
+        while completed < len(concepts):
+            try:
+                concepts_done = done.get(timeout=1)
+                completed += concepts_done
+                stage.item(count=concepts_done)
+                pbar.update(completed - pbar.n)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    break
+            try:
+                stage.queue_depth(tasks.qsize())
+            except NotImplementedError:
+                # Not available on macOS
+                pass
+    pbar.close()
+    for worker in workers:
+        worker.join()
+    failed = [device for device, worker in zip(devices, workers) if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Generation workers failed on {', '.join(failed)}: rerun to resume the missing concepts")
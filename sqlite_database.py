@@ -0,0 +1,53 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Stay below SQLite's limit on the number of query parameters
+MAX_PARAMETERS = 500
+
+
+class SQLiteDatabase:
+    """
+    SQLite connection shared by the threads of a process, for the caches and indexes that several processes
+    (the sharded workers) and threads (the image writer, the scorer of interrogate-evaluate) update together.
+    Writes happen in transactions that take the database lock right away, so a writer waits for the others
+    (for at most timeout seconds) instead of failing, and the threads of the process take turns on the connection.
+    """
+
+    def __init__(self, path: str, timeout: float = 600) -> None:
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+
+    def execute(self, sql: str, parameters: tuple = ()) -> sqlite3.Cursor:
+        return self.connection.execute(sql, parameters)
+
+    def executemany(self, sql: str, parameters: list) -> sqlite3.Cursor:
+        return self.connection.executemany(sql, parameters)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Write transaction: it excludes the other processes (and the other threads of this one) until it ends
+        """
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def select_in(self, sql: str, parameters: tuple, values: list) -> list:
+        """
+        Returns the rows of sql, whose "IN ({})" is filled with values, MAX_PARAMETERS values at a time;
+        parameters are the values of the placeholders before it
+        """
+        rows = []
+        for start in range(0, len(values), MAX_PARAMETERS):
+            chunk = values[start:start + MAX_PARAMETERS]
+            rows.extend(self.connection.execute(sql.format(", ".join("?" * len(chunk))), (*parameters, *chunk)))
+        return rows
+
+    def close(self) -> None:
+        self.connection.close()
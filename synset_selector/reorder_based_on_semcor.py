@@ -1,11 +1,14 @@
+import os
 import random
-from collections import Counter
+import sys
 from typing import List, Tuple, Dict
 
-from nltk.corpus import semcor
 from nltk.corpus import wordnet as wn
 from nltk.corpus.reader.wordnet import Synset as syn
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from semcor_index import SemcorFrequencyIndex  # noqa: E402
+
 
 # This code is so bad that I don't even want to look at it anymore
 # So please don't judge me for it: it does its job, and that's all that matters
@@ -27,15 +30,9 @@ def create_dict(file1: str, file2: str) -> Dict[syn, syn]:
 
 
 def reorder_based_on_semcor_frequency(synset_dict: Dict[syn, syn]) -> List[Tuple[syn, syn]]:
-    synsets_list = []
-    for sent in semcor.sents():
-        for word in sent:
-            sent_synsets = wn.synsets(word)
-            synsets_list.extend(sent_synsets)
-
-    counter = Counter(synsets_list)
-    sorted_synsets = [(synset, synset_dict[synset]) for synset in sorted(counter, key=counter.get, reverse=True) if
-                      synset in synset_dict]
+    # Frequencies come from the SemCor index, built on the first run only
+    index = SemcorFrequencyIndex()
+    sorted_synsets = [(synset, synset_dict[synset]) for synset in index.sort_by_frequency(synset_dict)]
     return sorted_synsets
 
 
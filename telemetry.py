@@ -0,0 +1,239 @@
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Every process of a run appends to the same file; the run id is inherited by the worker processes
+TELEMETRY_PATH = os.environ.get("PIPELINE_TELEMETRY", "telemetry.jsonl")
+_lock = threading.Lock()
+
+
+def run_id() -> str:
+    """
+    Identifies the current pipeline run, shared by the processes it spawns
+    """
+    if "PIPELINE_RUN_ID" not in os.environ:
+        os.environ["PIPELINE_RUN_ID"] = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+    return os.environ["PIPELINE_RUN_ID"]
+
+
+def process_peak_rss_mb() -> float:
+    """
+    Peak resident memory of the process since it started (it cannot be reset)
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return maxrss / 2 ** 20 if sys.platform == "darwin" else maxrss / 1024
+
+
+def _cuda():
+    try:
+        import torch
+    except ImportError:
+        return None
+    if not torch.cuda.is_available() or not torch.cuda.is_initialized():
+        return None
+    return torch.cuda
+
+
+def reset_device_peak() -> None:
+    cuda = _cuda()
+    if cuda is not None:
+        for device in range(cuda.device_count()):
+            cuda.reset_peak_memory_stats(device)
+
+
+def device_peak_mb() -> float:
+    """
+    Peak device memory allocated by the process since the last reset_device_peak()
+    """
+    cuda = _cuda()
+    if cuda is None:
+        return None
+    return sum(cuda.max_memory_allocated(device) for device in range(cuda.device_count())) / 2 ** 20
+
+
+def emit(record: dict) -> None:
+    """
+    Appends a record to the telemetry file, as a single json line
+    """
+    record = {"run": run_id(), "pid": os.getpid(), "time": time.time(), **record}
+    line = json.dumps(record) + "\n"
+    with _lock, open(TELEMETRY_PATH, "a") as f:
+        f.write(line)
+
+
+class Stage:
+    """
+    Measures a pipeline stage (used as a context manager) and emits a single "stage" record when it ends:
+    wall time, items and items/s, percentiles of the per-item latencies, queue depths, the peak device memory
+    of the stage and the peak RSS of the process so far (the kernel cannot reset it, so it is a process-wide peak).
+    The device peak is reset when the stage starts: a stage running at the same time in another thread of the process
+    shares it.
+    """
+
+    def __init__(self, name: str, **fields) -> None:
+        self.name = name
+        self.fields = fields
+        self.items = 0
+        self.latencies = []
+        self.queue_depths = []
+        self.start = None
+
+    def __enter__(self):
+        reset_device_peak()
+        self.start = time.perf_counter()
+        return self
+
+    def item(self, latency: float = None, count: int = 1) -> None:
+        """
+        Counts count items done together, each of them having taken latency seconds (if known)
+        """
+        self.items += count
+        if latency is not None:
+            self.latencies.extend([latency] * count)
+
+    def queue_depth(self, depth: int) -> None:
+        self.queue_depths.append(depth)
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        wall = time.perf_counter() - self.start
+        record = {"type": "stage", "stage": self.name, "wall": wall, "items": self.items,
+                  "items_per_s": self.items / wall if wall else None, "failed": exc_type is not None,
+                  "process_peak_rss_mb": process_peak_rss_mb(), "device_peak_mb": device_peak_mb(), **self.fields}
+        if self.latencies:
+            p50, p90, p99 = np.percentile(self.latencies, [50, 90, 99]).tolist()
+            record.update(latency_p50=p50, latency_p90=p90, latency_p99=p99)
+        if self.queue_depths:
+            record.update(queue_depth_mean=float(np.mean(self.queue_depths)), queue_depth_max=max(self.queue_depths))
+        emit(record)
+
+
+class ModelCall:
+    """
+    Measures one call to a model (used as a context manager) and emits a "call" record with its wall time
+    and the number of items it processed
+    """
+
+    def __init__(self, model: str, items: int) -> None:
+        self.model = model
+        self.items = items
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        emit({"type": "call", "model": self.model, "items": self.items, "wall": time.perf_counter() - self.start})
+
+
+def load_all(path: str = TELEMETRY_PATH) -> list:
+    """
+    Returns every record of the telemetry file, skipping truncated lines
+    """
+    records = []
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    return records
+
+
+def load(path: str = TELEMETRY_PATH, run: str = None) -> list:
+    """
+    Returns the records of run (the last run of the file when None)
+    """
+    records = load_all(path)
+    if run is None and records:
+        run = records[-1]["run"]
+    return [record for record in records if record["run"] == run]
+
+
+def runs(path: str = TELEMETRY_PATH) -> list:
+    """
+    Returns the ids of the runs of the telemetry file, oldest first
+    """
+    return list(dict.fromkeys(record["run"] for record in load_all(path)))
+
+
+def summarize(records: list) -> tuple:
+    """
+    Returns ({stage: summary}, {model: summary}) for the records of a run.
+    A stage that ran in several processes (the sharded workers) or several times is summed up.
+    """
+    stages, models = {}, {}
+    for record in records:
+        if record["type"] == "stage":
+            summary = stages.setdefault(record["stage"], {"runs": 0, "wall": 0.0, "items": 0,
+                                                          "process_peak_rss_mb": 0.0, "device_peak_mb": 0.0,
+                                                          "queue_depth_max": 0})
+            summary["runs"] += 1
+            summary["wall"] += record["wall"]
+            summary["items"] += record["items"]
+            # Formerly recorded as peak_rss_mb
+            summary["process_peak_rss_mb"] = max(summary["process_peak_rss_mb"], record.get(
+                "process_peak_rss_mb", record.get("peak_rss_mb")) or 0.0)
+            summary["device_peak_mb"] = max(summary["device_peak_mb"], record.get("device_peak_mb") or 0.0)
+            summary["queue_depth_max"] = max(summary["queue_depth_max"], record.get("queue_depth_max") or 0)
+            for percentile in ("latency_p50", "latency_p90", "latency_p99"):
+                if percentile in record:
+                    summary[percentile] = max(summary.get(percentile, 0.0), record[percentile])
+        elif record["type"] == "call":
+            summary = models.setdefault(record["model"], {"calls": 0, "items": 0, "wall": 0.0})
+            summary["calls"] += 1
+            summary["items"] += record["items"]
+            summary["wall"] += record["wall"]
+    for summary in list(stages.values()) + list(models.values()):
+        summary["items_per_s"] = summary["items"] / summary["wall"] if summary["wall"] else 0.0
+    return stages, models
+
+
+def report(path: str = TELEMETRY_PATH, run: str = None) -> None:
+    """
+    Prints the summary of a run (the last one by default) next to the previous run,
+    so a drop in throughput stands out
+    """
+    ids = runs(path)
+    if not ids:
+        print(f"No telemetry in {path}")
+        return
+    run = run if run is not None else ids[-1]
+    previous = ids[ids.index(run) - 1] if ids.index(run) > 0 else None
+    stages, models = summarize(load(path, run))
+    previous_stages, previous_models = summarize(load(path, previous)) if previous else ({}, {})
+
+    def change(current, before):
+        if not before:
+            return ""
+        return f" ({(current / before - 1) * 100:+.1f}% vs {previous})"
+
+    print(f"Run {run}")
+    for stage, summary in stages.items():
+        print(f"  stage {stage}: {summary['items']} items in {summary['wall']:.1f}s, "
+              f"{summary['items_per_s']:.2f} items/s"
+              f"{change(summary['items_per_s'], previous_stages.get(stage, {}).get('items_per_s'))}")
+        if "latency_p50" in summary:
+            print(f"    latency p50 {summary['latency_p50']:.3f}s, p90 {summary['latency_p90']:.3f}s, "
+                  f"p99 {summary['latency_p99']:.3f}s")
+        print(f"    process peak RSS {summary['process_peak_rss_mb']:.0f} MB, "
+              f"stage device peak {summary['device_peak_mb']:.0f} MB, "
+              f"max queue depth {summary['queue_depth_max']}")
+    for model, summary in models.items():
+        print(f"  model {model}: {summary['calls']} calls, {summary['items']} items in {summary['wall']:.1f}s, "
+              f"{summary['items_per_s']:.2f} items/s"
+              f"{change(summary['items_per_s'], previous_models.get(model, {}).get('items_per_s'))}")
@@ -1,9 +1,18 @@
+import multiprocessing as mp
+import os
+import sys
 from collections import Counter
 
 import nltk
 
 from transformers_filter import TransFilter
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from semcor_index import SemcorFrequencyIndex  # noqa: E402
+
+# Middle concepts, a hyponym whose lexeme is one of theirs is not picked (see HyponymSelector.is_common)
+synsets = []
+
 
 def filter_synsets(synset_counter, common_nouns_synsets, n) -> list:
     most_common_synsets = [synset for synset, _ in synset_counter.most_common(n)]
@@ -68,69 +77,122 @@ def isolate_nouns(synsets) -> list:
 
 def get_best_synsets(n) -> list:
     """
-    Returns the most frequent synsets
+    Returns the most frequent synsets: the n noun synsets that are the most frequent in SemCor
+    (according to the SemCor frequency index) or among the Ogden words, and the synsets of the common nouns
     """
     ogden_words = retrieve_ogden_words()
     common_nouns = retrieve_common_nouns()
-    words = semcor.words()
     ogden_synsets = synset_converter(ogden_words)
     common_nouns_synsets = synset_converter(common_nouns)
-    word_synsets = synset_converter(words)
-    merged_synsets = ogden_synsets + word_synsets
-    synsets = isolate_nouns(merged_synsets)
-    synset_counter = count_synsets(synsets)
+    synset_counter = count_synsets(isolate_nouns(ogden_synsets))
+    synset_counter.update(dict(SemcorFrequencyIndex().most_common(n, pos='n')))
     return filter_synsets(synset_counter, common_nouns_synsets, n)
 
 
-def get_most_frequent_hyponyms(most_frequent_synsets) -> dict:
+def get_most_frequent_hyponyms(most_frequent_synsets, processes=None) -> dict:
     """
     Returns the most frequent hyponyms.
     Build a dictionary of the form {synset: best_hyponym}
     where the best_hyponym is the hyponym with the highest frequency
     and not too close with his hypernym
     """
-    return get_best_hyponym(get_hyponyms(most_frequent_synsets))
-
-
-def get_hyponyms(most_frequent_synsets) -> dict:
-    return {synset: list(set([i for i in synset.closure(lambda s: s.hyponyms())])) for synset in most_frequent_synsets}
+    return HyponymSelector(synsets).select(most_frequent_synsets, processes)
 
 
-def get_best_hyponym(hyponyms: dict):
-    return {synset: get_best_hyponym_from_list(hyponym_list, synset) for synset, hyponym_list in
-            hyponyms.items()}
-
-
-def get_best_hyponym_from_list(hyponym_list, synset) -> nltk.corpus.reader.wordnet.Synset:
+class HyponymSelector:
     """
-    Returns the best hyponym from a list of hyponyms.
-    The best hyponym is the hyponym with a high frequency (in the top 10 of most frequent hyponyms)
-    and not too close with his hypernym, with a path_similarity > 0.63.
-    It is also required that the hypoynm cannot share a word with the hypernym.
+    Picks the best hyponym of every synset of a list (see best_hyponym).
+    The lemmas of the common synsets (the middle concepts) are gathered once in a set, the hypernym distances
+    behind path_similarity are memoized per synset (a hyponym shared by several roots is only walked once),
+    and the roots are spread over a process pool by select(): workers get and return synset names,
+    since a Synset drags its whole corpus reader along when pickled.
     """
-    for hyponym in hyponym_list:
-        if hyponym.pos() == 'n' \
-                and hyponym.path_similarity(synset) <= 0.63 \
-                and is_in_top_10(hyponym, hyponym_list) \
-                and not share_words(hyponym, synset) \
-                and not is_common(hyponym):
-            return hyponym
-    for hyponym in hyponym_list:
-        if hyponym.pos() == 'n' \
-                and hyponym.path_similarity(synset) <= 0.63 \
-                and not share_words(hyponym, synset) \
-                and not is_common(hyponym):
-            return hyponym
-    return None
 
-
-def is_in_top_10(hyponym, hyponym_list) -> bool:
-    """
-    Returns True if the hyponym is in the top 5 of most frequent hyponyms
-    """
-    hyponym_counter = Counter()
-    hyponym_counter.update(hyponym_list)
-    return hyponym in [hyponym for hyponym, _ in hyponym_counter.most_common(10)]
+    def __init__(self, common_synsets=()) -> None:
+        self.common_lemmas = {lemma for synset in common_synsets for lemma in synset.lemma_names()}
+        self.distances = {}
+
+    @staticmethod
+    def hyponyms(synset) -> list:
+        """
+        Returns every hyponym of synset, the nearest ones first
+        """
+        return list(dict.fromkeys(synset.closure(lambda s: s.hyponyms())))
+
+    def hypernym_distances(self, synset) -> dict:
+        """
+        Returns {ancestor: length of the shortest hypernym path} for synset and all its ancestors,
+        as Synset.shortest_path_distance computes them
+        """
+        if synset not in self.distances:
+            distances = {synset: 0}
+            for parent in synset.hypernyms() + synset.instance_hypernyms():
+                for ancestor, distance in self.hypernym_distances(parent).items():
+                    if distance + 1 < distances.get(ancestor, float("inf")):
+                        distances[ancestor] = distance + 1
+            self.distances[synset] = distances
+        return self.distances[synset]
+
+    def path_similarity(self, synset, other) -> float:
+        """
+        Same as synset.path_similarity(other) for two nouns
+        """
+        distances, other_distances = self.hypernym_distances(synset), self.hypernym_distances(other)
+        distance = min((d + other_distances[ancestor] for ancestor, d in distances.items()
+                        if ancestor in other_distances), default=None)
+        return None if distance is None else 1.0 / (distance + 1)
+
+    def is_common(self, hyponym) -> bool:
+        """
+        Check if the hyponym's lexeme is a middle-concept
+        """
+        return hyponym.lemma_names()[0] in self.common_lemmas
+
+    def best_hyponym(self, synset):
+        """
+        Returns the best hyponym of synset.
+        The best hyponym is the hyponym with a high frequency (in the top 10 of most frequent hyponyms)
+        and not too close with his hypernym, with a path_similarity > 0.63.
+        It is also required that the hypoynm cannot share a word with the hypernym.
+        """
+        # Every hyponym of the list is unique, so the 10 most frequent ones are the first 10:
+        # a suitable hyponym among them is also the first suitable hyponym of the list
+        for hyponym in self.hyponyms(synset):
+            if hyponym.pos() == 'n' \
+                    and self.path_similarity(hyponym, synset) <= 0.63 \
+                    and not share_words(hyponym, synset) \
+                    and not self.is_common(hyponym):
+                return hyponym
+        return None
+
+    def select(self, roots, processes=None) -> dict:
+        """
+        Returns {root: best hyponym (or None)} for every synset of roots, with a pool of processes
+        (os.cpu_count() by default, no pool with a single process)
+        """
+        roots = list(roots)
+        processes = processes or os.cpu_count() or 1
+        if processes == 1 or len(roots) < 2:
+            return {root: self.best_hyponym(root) for root in roots}
+        with mp.Pool(processes, initializer=_init_selector, initargs=(sorted(self.common_lemmas),)) as pool:
+            names = pool.map(_best_hyponym_name, [root.name() for root in roots],
+                             chunksize=max(1, len(roots) // (processes * 4)))
+        return {root: nltk.corpus.wordnet.synset(name) if name else None for root, name in zip(roots, names)}
+
+
+# Selector of a worker process of HyponymSelector.select
+_selector = None
+
+
+def _init_selector(common_lemmas: list) -> None:
+    global _selector
+    _selector = HyponymSelector()
+    _selector.common_lemmas = set(common_lemmas)
+
+
+def _best_hyponym_name(name: str) -> str:
+    hyponym = _selector.best_hyponym(nltk.corpus.wordnet.synset(name))
+    return hyponym.name() if hyponym is not None else None
 
 
 def share_words(hyponym, synset) -> bool:
@@ -144,22 +206,6 @@ def share_words(hyponym, synset) -> bool:
     return False
 
 
-def is_common(hyponym) -> bool:
-    """
-    Check if the hyponym's lexeme is a middle-concept
-    """
-    if len(synsets) == 0:
-        # This should never happen, but just in case... (it happened)
-        return False
-    else:
-        # Convert synsets in a list of their lexemes (words)
-        synsets_lexemes = [synset.lemma_names() for synset in synsets]
-        # Flatten the list
-        synsets_lexemes = [item for sublist in synsets_lexemes for item in sublist]
-        # Check if the hyponym's lexeme is in the list
-        return hyponym.lemma_names()[0] in synsets_lexemes
-
-
 def flush_to_file_hr(synsets, file_name) -> None:
     """
     Flushes the synsets, synonyms and hyponyms to a single file
@@ -224,6 +270,4 @@ def main() -> None:
 
 
 if __name__ == '__main__':
-    semcor = nltk.corpus.semcor
-    synsets = []
     main()
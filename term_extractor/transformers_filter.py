@@ -1,4 +1,13 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from llm_judge import YesNoJudge  # noqa: E402
+from telemetry import Stage  # noqa: E402
+
+TEMPLATE = "Is this a simple english word (example: dog -> yes, discombobulated -> no, beach -> yes, " \
+           "acquaintance -> no)? {word} ->"
 
 
 class TransFilter:
@@ -10,41 +19,57 @@ class TransFilter:
     def __init__(self, synsets: dict):
         self.synsets = synsets
         self.filtered_synsets = {}
+        # Probability that each processed synset is too complicated
+        self.probabilities = {}
         checkpoint = "facebook/opt-6.7b"
-        self.tokenizer = AutoTokenizer.from_pretrained(checkpoint)
-        self.model = AutoModelForCausalLM.from_pretrained(checkpoint, torch_dtype="auto", device_map="auto")
+        self.checkpoint = checkpoint
+        self.judge = YesNoJudge(checkpoint, TEMPLATE)
+        self.stage = None
 
     def batch_processing(self, batch_size=100):
         """
         Process the synsets in batches of size batch_size
         """
         synsets = list(self.synsets.keys())
-        for i in range(0, len(synsets), batch_size):
-            batch = synsets[i:i + batch_size]
-            self.process_batch(batch)
+        with Stage("trans-filter", model=self.judge.model_id, batch_size=batch_size) as self.stage:
+            for i in range(0, len(synsets), batch_size):
+                batch = synsets[i:i + batch_size]
+                self.process_batch(batch)
 
     def process_batch(self, batch):
         """
-        Process a batch of synsets
+        Process a batch of synsets, judged together by the model
         """
-        for synset in batch:
-            if self.is_too_complicated(synset):
+        start = time.perf_counter()
+        judged = self.too_complicated(batch)
+        if self.stage is not None:
+            self.stage.item(latency=time.perf_counter() - start, count=len(batch))
+        for synset, (too_complicated, probability) in zip(batch, judged):
+            self.probabilities[synset] = probability
+            if too_complicated:
                 print(f"Removing {synset.lemma_names()[0]}")
             else:
                 self.filtered_synsets[synset] = self.synsets[synset]
 
+    def too_complicated(self, synsets: list) -> list:
+        """
+        Returns, for each synset, whether it is too complicated for humans to understand
+        and the probability that it is (the model answering "no" to the simple word question)
+        """
+        probabilities = [1 - p for p in self.judge.yes_probabilities([synset.lemma_names()[0] for synset in synsets])]
+        return [(probability > 0.5, probability) for probability in probabilities]
+
     def is_too_complicated(self, synset) -> bool:
         """
         Returns True if the synset is too complicated for humans to understand
         """
-        inputs = self.tokenizer.encode(
-            f"Is this a simple english word (example: dog -> yes, discombobulated -> no, beach -> yes, acquaintance -> no)? {synset.lemma_names()[0]} ->",
-            return_tensors="pt").to("cuda")
-        outputs = self.model.generate(inputs)
-        return self.tokenizer.decode(outputs[0], skip_special_tokens=True)[-2:] == "no"
+        return self.too_complicated([synset])[0][0]
 
     def get_synsets(self) -> dict:
         return self.synsets
 
     def get_filtered_synsets(self) -> dict:
         return self.filtered_synsets
+
+    def get_probabilities(self) -> dict:
+        return self.probabilities